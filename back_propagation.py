@@ -1,111 +1,18 @@
-from collections import defaultdict
+import argparse
+import copy
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
 from heapq import *
+from time import perf_counter
 
 import numpy as np
-import pandas as pd
 
-
-def read_data(car_path, road_path, cross_path):
-    """
-    从给定的路径读取数据
-    :param filepath: 数据路径
-    :return: 读取的数据
-    """
-
-    def read_from_txt(path):
-        "从txt文件中读出数据"
-        with open(path) as f:
-            data = []
-            head = f.readline()[2: -2].split(',')
-            line = f.readline()
-            while line:
-                line = line.strip('(').strip('\n').strip(')').split(",")
-                data.append(list(map(int, line)))
-                line = f.readline()
-            data = pd.DataFrame(data, columns=head)
-        return data
-
-    carData = read_from_txt(car_path)
-    roadData = read_from_txt(road_path)
-    crossData = read_from_txt(cross_path)
-    return (carData, roadData, crossData)
-
-
-def create_road_between_cross_graph(roadData, crossData):
-    """
-    生成道路查找矩阵cross_graph;
-    生成cross间权值矩阵weight_matrix;
-    生成边 edges;
-    :param roadData:
-    :return:
-    """
-    M = 99999  # This represents that there is no link.
-    edges = []
-    cross_graph = dict()
-    adjacent_matrix = np.full((len(crossData), len(crossData)), M)
-
-    for i in range(len(roadData)):
-        cross_graph['{}{}'.format(roadData.values[i, 4] - 1, roadData.values[i, 5] - 1)] = roadData.id[i]
-        adjacent_matrix[roadData.values[i, 4] - 1, roadData.values[i, 5] - 1] \
-            = roadData.values[i, 1]
-        if roadData.isDuplex[i] == 1:
-            cross_graph['{}{}'.format(roadData.values[i, 5] - 1, roadData.iloc[i, 4] - 1)] = roadData.id[i]
-            adjacent_matrix[roadData.values[i, 5] - 1, roadData.values[i, 4] - 1] \
-                = roadData.values[i, 1]
-
-    # (i,j) is a link; adjacent[i, j] here is 1, the length of link (i,j).
-    for i in range(len(adjacent_matrix)):
-        for j in range(len(adjacent_matrix[0])):
-            if i != j and adjacent_matrix[i][j] != M:
-                edges.append((i, j, adjacent_matrix[i][j]))
-    return cross_graph, adjacent_matrix, edges
-
-
-def dijkstra(graph, start, end):
-    """
-    根据图的权值矩阵计算两点之间的最短路径dijkstra算法实现，
-    有向图和路由的源点作为函数的输入，最短路径作为输出
-    :param graph:
-    :param start:
-    :param end:
-    :return:
-    """
-
-    def dijkstra_raw(edges, from_node, to_node):
-        g = defaultdict(list)
-        for l, r, c in edges:
-            g[l].append((c, r))
-        q, seen = [(0, from_node, ())], set()
-        while q:
-            (cost, v1, path) = heappop(q)
-            if v1 not in seen:
-                seen.add(v1)
-                path = (v1, path)
-                if v1 == to_node:
-                    return cost, path
-                for c, v2 in g.get(v1, ()):
-                    if v2 not in seen:
-                        heappush(q, (cost + c, v2, path))
-        return float("inf"), []
-
-    def dijkstra(edges, from_node, to_node):
-        len_shortest_path = -1
-        ret_path = []
-        length, path_queue = dijkstra_raw(edges, from_node, to_node)
-        if len(path_queue) > 0:
-            len_shortest_path = length  ## 1. Get the length firstly;
-            ## 2. Decompose the path_queue, to get the passing nodes in the shortest path.
-            left = path_queue[0]
-            ret_path.append(left)  ## 2.1 Record the destination node firstly;
-            right = path_queue[1]
-            while len(right) > 0:
-                left = right[0]
-                ret_path.append(left)  ## 2.2 Record other nodes, till the source-node.
-                right = right[1]
-            ret_path.reverse()  ## 3. Reverse the list finally, to make it be normal sequence.
-        return len_shortest_path, ret_path
-
-    return dijkstra(graph, start, end)
+from data_io import read_data, read_plan, write_answer, csr_to_answer, CarTable, RoadTable, CrossTable
+from road_graph import dijkstra, route_entries
+from shared_array import share_array, attach_array
+from sim_profile import TickProfiler
 
 
 def generate_cross_path(carData, edges):
@@ -115,15 +22,14 @@ def generate_cross_path(carData, edges):
     :return: 车辆经过的节点answer_node_path --> list(id, PlanTime, node1, node2 ...)
     """
     # 给car的数据进行排序，按照出发时间-->出发地点-->速度
-    carData.sort_values(['planTime', 'from', 'speed'], ascending=[True, True, False], inplace=True)
+    order = np.lexsort((-carData.speed, carData['from'], carData.planTime))
     answer_node_path = []  # 总的输出结果
 
     # 先求出沿线通过的交叉路口
-    for i_car in range(len(carData)):
-        ans_one = []  # 给出当前车的结果路线
-        _, path = dijkstra(edges, carData.iloc[i_car, 1] - 1, carData.iloc[i_car, 2] - 1)
-        ans_one.append(carData.iloc[i_car, 0])
-        ans_one.append(carData.iloc[i_car, 4])
+    for car_id, plan_time, start, end in zip(carData.id[order].tolist(), carData.planTime[order].tolist(),
+                                             (carData['from'][order] - 1).tolist(), (carData.to[order] - 1).tolist()):
+        ans_one = [car_id, plan_time]  # 给出当前车的结果路线
+        _, path = dijkstra(edges, start, end)
         ans_one += path
         answer_node_path.append(ans_one)
     return answer_node_path
@@ -133,39 +39,19 @@ def generate_answer(answer_node_path, cross_road_map):
     """
     根据经过的交叉口生成道路id的结果
     :param answer_node_path: 规划路线中经过的交叉点的list
-    :param cross_road_map: 交叉点与道路编号的映射图
+    :param cross_road_map: 交叉点与道路编号的映射图，CSRGraph
     :return: 返回生成的规划线路的list
     """
     answer_road_path = []
-    for i_car in range(len(answer_node_path)):
-        ans_one = []
-        ans_one += answer_node_path[i_car][0: 2]
-        temp = answer_node_path[i_car][2:]
-        if len(temp) >= 2:
-            for i in range(len(temp) - 1):
-                ans_one.append(cross_road_map[str(temp[i]) + str(temp[i + 1])])
-        answer_road_path.append(ans_one)
-    return answer_road_path
-
-
-def update_departure_time(answer_road_path):
-    # 建立同一时刻放入车道中的车的数量
-    # 现在的answer_total为lis(list(id, route...)),调整出发时间
-    carNum = 1  # 相同时刻从同一个cross出发的车辆数
-    temp_from = answer_road_path[0][2]  # 当前车辆的出发cross
-    count = 1
-    for i_car in range(1, len(answer_road_path)):
-        # 后面一辆车的出发时间和前一辆车的出发时间相同时carNum加1
-        # if temp_from == answer_total[i_car][2]:
-        #     carNum += 100
-        #     answer_total[i_car][1] = carNum
-        # else:
-        #     temp_from = answer_total[i_car][2]
-        #     carNum = answer_total[i_car][1]
-        answer_road_path[i_car][1] = carNum
-        if count % 1 == 0:
-            carNum += 1
-        count += 1
+    for node_path in answer_node_path:
+        if len(node_path) < 4:
+            # 不可达时规划结果为空路线，至少要经过出发和到达两个交叉口
+            raise Exception('车辆{}没有可达的路线'.format(node_path[0]))
+        # 相邻两个交叉口直接在图中批量查出道路id
+        road_path = cross_road_map.road_ids(node_path[2:])
+        if (road_path < 0).any():
+            raise Exception('车辆{}的路线中存在不相连的交叉口'.format(node_path[0]))
+        answer_road_path.append(node_path[0: 2] + road_path.tolist())
     return answer_road_path
 
 
@@ -176,58 +62,165 @@ def write_answer_file(answer_list, answer_path):
     :param answer_path:
     :return:
     """
-    with open(answer_path, 'w') as f:
-        f.write('#(carId,StartTime,RoadID...)')
-        for cur_line in answer_list:
-            f.write('\n')
-            f.write(str(tuple(cur_line)))
+    write_answer(answer_path, answer_list)
     return
 
 
-class Car:
-    def __init__(self, id, v_lim, s1, length, channel, cur_road_num, is_reverse, state=0):
-        self.id = id
-        self.v_lim = v_lim
-        self.s1 = s1
-        self.state = state
-        self.channel = channel
-        self.road_length = length
-        self.is_reverse = is_reverse
-        self.cur_road_num = cur_road_num
+class RoadState:
+    """
+    道路与车辆状态的结构数组(struct of arrays)
+    每条道路的每个方向的每个车道编号为一个lane，车道是容量等于道路长度的环形队列，
+    车道上从路口往后数第i辆车为 slot_car[lane_base[lane] + (lane_head[lane] + i) % lane_len[lane]];
+    车辆按carData的行号编号，car_s1为到路口的剩余距离，car_v为在当前道路上的速度，
+    car_state中0表示终止状态，1表示等待状态，2表示已到达终点;
+    active为有车的车道编号集合，车辆驶入、驶出车道时更新，每个时刻只处理这些车道
+    """
+    # 只依赖于道路和车辆数据的数组，fork时共享
+    STATIC = ('lane_road', 'lane_dir', 'lane_len', 'lane_cross', 'lane_base', 'car_id', 'car_speed')
+    # 仿真过程中会改变的数组
+    MUTABLE = ('lane_head', 'lane_count', 'slot_car', 'car_s1', 'car_v', 'car_state', 'car_step', 'car_lane')
+
+    def __init__(self, roadData, carData):
+        lane_road, lane_dir, lane_len, lane_cross = [], [], [], []
+        for road_id, length, _, channel, road_from, road_to, is_duplex in roadData.values.tolist():
+            for road_dir in range(is_duplex + 1):
+                lane_road += [road_id] * channel
+                lane_dir += [road_dir] * channel
+                lane_len += [length] * channel
+                lane_cross += [road_to if road_dir == 0 else road_from] * channel
+        self.lane_road = np.array(lane_road, dtype=np.int64)
+        self.lane_dir = np.array(lane_dir, dtype=np.int64)
+        self.lane_len = np.array(lane_len, dtype=np.int64)
+        self.lane_cross = np.array(lane_cross, dtype=np.int64)  # 车道驶向的路口
+        self.lane_base = np.cumsum(self.lane_len) - self.lane_len
+        self.lane_head = np.zeros(len(lane_road), dtype=np.int64)
+        self.lane_count = np.zeros(len(lane_road), dtype=np.int64)
+        self.slot_car = np.full(int(self.lane_len.sum()), -1, dtype=np.int64)
+
+        n_car = len(carData)
+        self.car_id = carData.id.copy()
+        self.car_speed = carData.speed.copy()
+        self.car_s1 = np.zeros(n_car, dtype=np.int64)
+        self.car_v = np.zeros(n_car, dtype=np.int64)
+        self.car_state = np.zeros(n_car, dtype=np.int64)
+        self.car_step = np.zeros(n_car, dtype=np.int64)
+        self.car_lane = np.full(n_car, -1, dtype=np.int64)
+        self._build_index()
+
+    def _build_index(self):
+        # 同一道路同一方向的车道编号是连续的
+        self.road_lanes = dict()  # (道路id, 方向) --> 车道编号range，方向0为正向，1为反向
+        for lane, key in enumerate(zip(self.lane_road.tolist(), self.lane_dir.tolist())):
+            start = self.road_lanes[key].start if key in self.road_lanes else lane
+            self.road_lanes[key] = range(start, lane + 1)
+        self.car_index = dict(zip(self.car_id.tolist(), range(len(self.car_id))))
+        self.active = set(np.flatnonzero(self.lane_count).tolist())
+        # 分段累计最大值时每个车道的偏移量，需要大于车道内数值的变化范围
+        self._big = 4 * (int(self.lane_len.max(initial=0)) + int(self.car_speed.max(initial=0)) + 1)
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        "由save_state保存的数组恢复状态，数组可以是np.load得到的内存映射"
+        state = cls.__new__(cls)
+        for name in cls.STATIC + cls.MUTABLE:
+            setattr(state, name, arrays[name])
+        state._build_index()
+        return state
+
+    def fork(self):
+        "复制出一个独立的状态，静态数组和索引共享，只复制仿真中会改变的数组"
+        state = copy.copy(self)
+        for name in self.MUTABLE:
+            setattr(state, name, getattr(self, name).copy())
+        state.active = set(self.active)
+        return state
+
+    def lane_cars(self, lane):
+        "车道上的车辆list，从路口往后排列"
+        cnt = int(self.lane_count[lane])
+        slots = (self.lane_head[lane] + np.arange(cnt)) % self.lane_len[lane] + self.lane_base[lane]
+        return self.slot_car[slots].tolist()
+
+    def head(self, lane):
+        "车道的第一辆车，空车道返回-1"
+        if not self.lane_count[lane]:
+            return -1
+        return int(self.slot_car[self.lane_base[lane] + self.lane_head[lane]])
+
+    def last(self, lane):
+        "车道的最后一辆车，空车道返回-1"
+        cnt = self.lane_count[lane]
+        if not cnt:
+            return -1
+        return int(self.slot_car[self.lane_base[lane] + (self.lane_head[lane] + cnt - 1) % self.lane_len[lane]])
+
+    def popleft(self, lane):
+        "第一辆车驶出车道"
+        self.lane_head[lane] = (self.lane_head[lane] + 1) % self.lane_len[lane]
+        self.lane_count[lane] -= 1
+        if not self.lane_count[lane]:
+            self.active.discard(lane)
+
+    def append(self, lane, car):
+        "车辆驶入车道末尾"
+        cnt = self.lane_count[lane]
+        self.slot_car[self.lane_base[lane] + (self.lane_head[lane] + cnt) % self.lane_len[lane]] = car
+        self.lane_count[lane] = cnt + 1
+        self.car_lane[car] = lane
+        if not cnt:
+            self.active.add(lane)
+
+    def finish(self, car):
+        "车辆到达终点"
+        self.car_state[car] = 2
+        self.car_lane[car] = -1
+
+
+def get_channel(road_map, in_lanes, length):
+    """
+    根据当前的条件获取下一条路的流入车道
+    :param in_lanes: 下一条路上与行驶方向一致的所有车道
+    :param length: 下一条路的长度
+    :return: 进入的车道，所有车道都被处于终止状态的车排满时返回-1
+    """
+    for lane in in_lanes:
+        # 车道排满且最后一辆车在等待时，本车也要等待，不能换到后面的车道
+        last = road_map.last(lane)
+        if last < 0 or road_map.car_s1[last] < length - 1 or road_map.car_state[last] == 1:
+            return lane
+    return -1
+
+
+def move_to_next_road(road_map, car, in_lanes, next_road_num, road_info):
+    """
+    车辆通过路口驶入下一条路，不能通过时行驶到当前道路的最前端
+    :return: (old_lane, moved) moved为False表示被下一条路上等待的车挡住，本时刻继续等待
+    """
+    next_road_length = road_info[next_road_num][0]
+    next_road_v_lim = min(road_info[next_road_num][1], int(road_map.car_speed[car]))
+    old_lane = int(road_map.car_lane[car])
+    s2 = next_road_v_lim - int(road_map.car_s1[car])  # 通过路口后在下一条路上还能行驶的距离
+    lane = get_channel(road_map, in_lanes, next_road_length) if s2 > 0 else -1
+
+    if lane < 0:
+        road_map.car_state[car] = 0
+        road_map.car_s1[car] = 0
+        return old_lane, True
+    s1 = next_road_length - s2
+    last = road_map.last(lane)
+    if last >= 0 and road_map.car_s1[last] >= s1:
+        # 前车处于等待状态时本车也只能等待，否则跟在前车后面
+        if road_map.car_state[last] == 1:
+            return old_lane, False
+        s1 = int(road_map.car_s1[last]) + 1
+    road_map.popleft(old_lane)  # 只有车道的第一辆车会通过路口
+    road_map.car_v[car] = next_road_v_lim
+    road_map.car_s1[car] = s1
+    road_map.car_state[car] = 0
+    road_map.car_step[car] += 1
+    road_map.append(lane, car)
+    return old_lane, True
 
-    def getChannel(self, in_road) -> int:
-        """
-        根据当前的条件获取下一条路的流入车道
-        :param cur_cross: 当前交叉路口
-        :param cur_road: 当前道路
-        :param dir: 车辆的转向,1表示左转，2表示直行，3表示右转
-        :return: 进入的车道号
-        """
-        for i in range(len(in_road)):
-            if in_road[i] == [] or in_road[i][-1].s1 < in_road[i][-1].road_length - 1:
-                return in_road[i]
-        raise Exception('car.getChannel模块获取进入通道失败')
-
-    def moveToNextRoad(self, channel, next_road_num, is_reverse, road_info):
-        next_road_length = road_info[next_road_num][0]
-        next_road_v_lim = min(road_info[next_road_num][1], self.v_lim)
-
-        if next_road_length - self.s1 > 0:
-            old_channel = self.channel
-            self.channel.remove(self)
-            self.channel = channel
-            self.v_lim = next_road_v_lim
-            self.s1 = next_road_length - (next_road_v_lim - self.s1)
-            self.road_length = next_road_length
-            self.state = 0
-            self.is_reverse = is_reverse
-            self.cur_road_num = next_road_num
-            channel.append(self)
-        else:
-            old_channel = self.channel
-            self.state = 0
-            self.s1 = 0
-        return old_channel
 
 def generate_road_map(roadData, crossData, carData, answer_road_path):
     """
@@ -235,357 +228,760 @@ def generate_road_map(roadData, crossData, carData, answer_road_path):
     :param roadData:
     :return:车辆的
     """
-    road_map = dict()
+    road_map = RoadState(roadData, carData)
     road_info = dict()
     answer_map = dict()
     cross_map = dict()
     car_map = dict()
 
-    for temp in roadData.values:
-        road_map[temp[0]] = [[[] for _ in range(temp[3])] for _ in range(temp[6] + 1)]
+    for temp in roadData.values.tolist():
         road_info[temp[0]] = list(temp[1:])
 
     for i in range(len(answer_road_path)):
         # answer_map是车辆的行驶线路map
         answer_map[answer_road_path[i][0]] = answer_road_path[i][1:]
 
-    for temp in crossData.values:
+    for temp in crossData.values.tolist():
         cross_map[temp[0]] = list(temp[1:])
 
-    for temp in carData.values:
+    for temp in carData.values.tolist():
         car_map[temp[0]] = list(temp[1:])
 
     return road_map, road_info, answer_map, cross_map, car_map
 
 
-def get_car_from_road(cur_road_num, cur_cross_num, road_map: dict, cross_map: dict, answer_map: dict, dir: list):
-    # 判断当前路段的车辆判断顺序
-    road_dir = 0 if cross_map[cur_cross_num].index(cur_road_num) // 2 else 1
-    temp_road = road_map[cur_road_num][road_dir]
-    temp_car = []
-    for temp_channel in temp_road:
-        temp_car += temp_channel[:1]
-    for dir_order in dir:
-        for car_order in temp_car:
-            if car_order.state == 1 and dir_order == get_car_direction(car_order, cur_cross_num, cross_map, answer_map):
-                return dir_order, car_order
-    raise Exception('没有车应该出库')
-
-
-def drive_car_in_road_to_end(cur_road_num, cur_channel, answer_map, state):
-    wait_cars = []
-    stop_cars = []
-
-    if state == 0:
-        # 将车道上能到达终点的车安排到达终点
-        while cur_channel !=[] and answer_map[cur_channel[0].id][-1] == cur_road_num \
-                and cur_channel[0].s1 < cur_channel[0].v_lim:
-            stop_cars.append(cur_channel[0])
-            cur_channel[0].channel.remove(cur_channel[0])
-
-        # 先对车道内的第一辆车进行标记,0表示终止状态，1表示等待状态
-        if not cur_channel:
-            return wait_cars, stop_cars
-        if cur_channel[0].s1 >= cur_channel[0].v_lim:
-            cur_channel[0].state = 0
-            cur_channel[0].s1 -= cur_channel[0].v_lim
-            stop_cars.append(cur_channel[0])
-        else:
-            cur_channel[0].state = 1
-            wait_cars.append(cur_channel[0])
-
-        # 对车道上的其他车进行标记
-        for i in range(1, len(cur_channel)):
-            if cur_channel[i - 1].state == 0 or (cur_channel[i].s1 - cur_channel[i-1].s1 > cur_channel[i].v_lim):
-                cur_channel[i].state = 0  # 车辆到达终止状态
-                cur_channel[i].s1 = max(cur_channel[i].s1 - cur_channel[i].v_lim, cur_channel[i-1].s1 + 1)  # 移动车辆的位置
-                stop_cars.append(cur_channel[i])
+class RouteSteps:
+    """
+    编译后的车辆路线，所有车辆的每一步按顺序存放在扁平的list中
+    第k步表示车辆行驶在road[k]上，驶向路口cross[k]:
+    next_road[k]: 下一条路，-1表示road[k]是最后一条路
+    turn[k]: 在cross[k]的转向，1表示左转，2表示直行，3表示右转，到达终点视为直行
+    is_reverse[k]: 在road[k]上的行驶方向，0为正向，1为反向
+    first[car_id]: 车辆第一步的下标，之后每通过一个路口下标加1
+    is_last: road[k]是否为最后一条路的bool数组，供批量计算时使用
+    """
+
+    def __init__(self, road, next_road, turn, is_reverse, cross, first, is_last):
+        self.road = road
+        self.next_road = next_road
+        self.turn = turn
+        self.is_reverse = is_reverse
+        self.cross = cross
+        self.first = first
+        self.is_last = is_last
+
+
+def compile_routes(answer_road_path, roadData, crossData, carData):
+    """
+    在加载时把每辆车的路线编译为RouteSteps，仿真时转向和下一条路都是O(1)查表
+    :param answer_road_path: list(id, StartTime, road1, road2 ...)
+    :return: RouteSteps
+    """
+    car_ids = np.array([temp[0] for temp in answer_road_path], dtype=np.int64)
+    counts = np.array([len(temp) - 2 for temp in answer_road_path], dtype=np.int64)
+    roads = np.fromiter((road for temp in answer_road_path for road in temp[2:]), dtype=np.int64,
+                        count=counts.sum())
+    first = np.cumsum(counts) - counts
+    is_first = np.zeros(len(roads), dtype=bool)
+    is_first[first] = True
+    is_last = np.roll(is_first, -1)
+
+    road_rows, road_from, road_to, entry = route_entries(car_ids, carData['from'][carData.rows(car_ids)], counts,
+                                                         roads, roadData)
+    is_reverse = (road_from != entry).astype(np.int64)
+    cross = np.where(is_reverse == 1, road_from, road_to)
+    next_road = np.where(is_last, -1, np.roll(roads, -1))
+
+    # 转向由两条路在路口道路列表中的位置差决定
+    cross_roads = crossData.roadId[crossData.rows(cross)]
+    cur_match = cross_roads == roads[:, None]
+    next_match = cross_roads == next_road[:, None]
+    valid = cur_match.any(axis=1) & (next_match.any(axis=1) | is_last)
+    if not valid.all():
+        bad_car = car_ids[np.searchsorted(first, np.argmin(valid), side='right') - 1]
+        raise Exception('车辆{}的路线不连续'.format(bad_car))
+    turn = np.where(is_last, 2, (next_match.argmax(axis=1) - cur_match.argmax(axis=1)) % 4)
+
+    return RouteSteps(roads.tolist(), next_road.tolist(), turn.tolist(), is_reverse.tolist(), cross.tolist(),
+                      dict(zip(car_ids.tolist(), first.tolist())), is_last)
+
+
+def get_car_from_road(cur_road_num, cur_cross_num, road_map: RoadState, road_info: dict):
+    """
+    取出道路上驶向当前路口、优先级最高的等待车辆
+    只有车道的第一辆车可能通过路口，离路口最近的优先，距离相同时车道号小的优先
+    :return: 车辆编号，没有等待的车辆时返回-1
+    """
+    road_dir = 0 if road_info[cur_road_num][4] == cur_cross_num else 1
+    top_car = -1
+    for lane in road_map.road_lanes.get((cur_road_num, road_dir), ()):
+        car = road_map.head(lane)
+        if car >= 0 and road_map.car_state[car] == 1 and \
+                (top_car < 0 or road_map.car_s1[car] < road_map.car_s1[top_car]):
+            top_car = car
+    return top_car
+
+
+def _segment_cumsum(x, first):
+    "每个车道内的累加和，first为每个元素所在车道第一个元素的下标"
+    total = np.cumsum(x)
+    return total - total[first] + x[first]
+
+
+def drive_lanes_to_end(road_map: RoadState, route_steps):
+    """
+    第一遍调度: 所有车道上的车辆同时行驶，用numpy批量计算
+    车道前面能到达终点的车驶出; 头车能在本道路内行驶完就到达终止状态，否则等待通过路口;
+    后面的车被等待的车挡住时等待，否则行驶到 max(s1 - v, 前车 + 1)，用车道内的累计最大值一次算出
+    :return: (has_car, wait_count) wait_count[cross][road]为驶向路口cross的道路road上等待的车辆数
+    """
+    if not road_map.active:
+        return False, dict()
+    active = np.array(sorted(road_map.active), dtype=np.int64)
+    cnt = road_map.lane_count[active]
+    lane_of = np.repeat(active, cnt)
+    first = np.repeat(np.cumsum(cnt) - cnt, cnt)
+    rank = np.arange(len(lane_of)) - first
+    slots = road_map.lane_base[lane_of] + (road_map.lane_head[lane_of] + rank) % road_map.lane_len[lane_of]
+    cars = road_map.slot_car[slots]
+    s1 = road_map.car_s1[cars]
+    t = s1 - road_map.car_v[cars]  # 不受阻挡时行驶后的位置
+
+    # 车道前面连续的、本时刻能到达终点的车辆驶出
+    arrive = route_steps.is_last[road_map.car_step[cars]] & (t < 0)
+    arrive &= _segment_cumsum(~arrive, first) == 0
+    if arrive.any():
+        n_arrive = np.bincount(np.searchsorted(active, lane_of[arrive]), minlength=len(active))
+        road_map.lane_head[active] = (road_map.lane_head[active] + n_arrive) % road_map.lane_len[active]
+        road_map.lane_count[active] -= n_arrive
+        road_map.active.difference_update(active[road_map.lane_count[active] == 0].tolist())
+        road_map.car_state[cars[arrive]] = 2
+        road_map.car_lane[cars[arrive]] = -1
+        keep = ~arrive
+        rank = rank[keep] - np.repeat(n_arrive, cnt)[keep]
+        lane_of, cars, s1, t = lane_of[keep], cars[keep], s1[keep], t[keep]
+        first = np.arange(len(lane_of)) - rank
+    if not len(cars):
+        return True, dict()
+
+    # 头车不能在本道路内行驶完时等待，后面的车被等待的前车挡住时等待
+    prev_s1 = np.roll(s1, 1)
+    wait = np.where(rank == 0, t < 0, t <= prev_s1)
+    wait &= _segment_cumsum(~wait, first) == 0
+    # 终止状态的车: new_s1 - rank = max(t - rank, 前车的new_s1 - (rank - 1))，是车道内的累计最大值
+    offset = np.cumsum(rank == 0) * road_map._big
+    new_s1 = np.maximum.accumulate(np.where(wait, s1, t) - rank + offset) - offset + rank
+    road_map.car_s1[cars] = np.where(wait, s1, new_s1)
+    road_map.car_state[cars] = wait
+
+    wait_count = dict()
+    wait_lanes, wait_n = np.unique(lane_of[wait], return_counts=True)
+    for cross, road, n in zip(road_map.lane_cross[wait_lanes].tolist(), road_map.lane_road[wait_lanes].tolist(),
+                              wait_n.tolist()):
+        cross_wait = wait_count.setdefault(cross, dict())
+        cross_wait[road] = cross_wait.get(road, 0) + n
+    return True, wait_count
+
+
+def drive_car_in_road_to_end(road_map: RoadState, lane, route_steps):
+    """
+    前车离开或停在路口后，依次更新车道上后面处于等待状态的车
+    :return: 由等待变为终止状态(包括到达终点)的车辆数
+    """
+    stop_num = 0
+    while True:
+        car = road_map.head(lane)
+        if car < 0 or road_map.car_state[car] != 1 or not route_steps.is_last[road_map.car_step[car]] \
+                or road_map.car_s1[car] >= road_map.car_v[car]:
+            break
+        road_map.popleft(lane)
+        road_map.finish(car)
+        stop_num += 1
+
+    prev = -1
+    for car in road_map.lane_cars(lane):
+        if road_map.car_state[car] == 1:
+            if prev < 0:
+                if road_map.car_s1[car] < road_map.car_v[car]:
+                    break  # 头车仍然需要等待通过路口
+                road_map.car_s1[car] -= road_map.car_v[car]
+            elif road_map.car_state[prev] == 0:
+                # 移动车辆的位置
+                road_map.car_s1[car] = max(road_map.car_s1[car] - road_map.car_v[car], road_map.car_s1[prev] + 1)
             else:
-                cur_channel[i].state = 1  # 车辆为等待状态
-                wait_cars.append(cur_channel[i])
-    else:
-        while cur_channel != [] and answer_map[cur_channel[0].id][-1] == cur_road_num \
-                and cur_channel[0].s1 < cur_channel[0].v_lim and cur_channel[0].state == 1:
-            stop_cars.append(cur_channel[0])
-            cur_channel[0].channel.remove(cur_channel[0])
-
-        # 先对车道内的第一辆车进行标记,0表示终止状态，1表示等待状态
-        if not cur_channel:
-            return wait_cars, stop_cars
-        if cur_channel[0].state == 1:
-            if cur_channel[0].s1 >= cur_channel[0].v_lim:
-                cur_channel[0].state = 0
-                cur_channel[0].s1 -= cur_channel[0].v_lim
-                stop_cars.append(cur_channel[0])
-
-                # 对车道上的其他车进行标记
-                for i in range(1, len(cur_channel)):
-                    if cur_channel[i].state == 1:
-                        cur_channel[i].state = 0  # 车辆到达终止状态
-                        cur_channel[i].s1 = max(cur_channel[i].s1 - cur_channel[i].v_lim, cur_channel[i - 1].s1 + 1)  # 移动车辆的位置
-                        stop_cars.append(cur_channel[i])
-    return wait_cars, stop_cars
-
-
-def get_car_direction(car: Car, cur_cross_num: int, cross_map: dict, answer_map: dict) -> int:
-    car_path_list = answer_map[car.id][1:]
-    if car.id == 10019 and car.cur_road_num==5024:
-        print('sad')
-    cur_index = car_path_list.index(car.cur_road_num)
-    if cur_index == len(car_path_list) - 1:
-        return 2
-    in_road = car_path_list[cur_index + 1]
-    start = cross_map[cur_cross_num].index(car.cur_road_num)
-    end = cross_map[cur_cross_num].index(in_road)
-    return (end + 4 - start) % 4
-
-
-def get_road_direction(cur_cross_num: int, cur_road_num: int, cross_map, road_map, answer_map, road_info) -> list:
-    # 获取当前道路的优先级list()
-    # 取当前每个通道的第一辆车判断优先级是否符合
-    dir = []
-    road_out = [1, 1, 0, 0]
-    cur_roads_list = cross_map[cur_cross_num][:]
-    cur_index = cur_roads_list.index(cur_road_num)
-    left_index = (cur_index + 1) % 4
-    direct_index = (cur_index + 2) % 4
-    right_index = (cur_index + 3) % 4
-    # 判断是否可以直行
-    dir.append(2)
-    if cur_roads_list[direct_index] == -1:
-        dir.remove(2)
-
-    # 判断是否可以左转
-    dir.append(1)
-    if cur_roads_list[left_index] != -1:
-        channel_top_car = []
-        if cur_roads_list[right_index] != -1:  # 保证右边有车道
-            if road_out[right_index] <= road_info[cur_roads_list[right_index]][-1]:
-                for temp_channel in road_map[cur_roads_list[right_index]][road_out[right_index]]:
-                    channel_top_car += temp_channel[:1]  # 取出每个车道的最前面一辆车判断是否发生冲突
-                for temp_car in channel_top_car:
-                    if temp_car.state == 1:
-                        if get_car_direction(temp_car, cur_cross_num, cross_map, answer_map) == 2:
-                            dir.remove(1)
-                            break
-    else:
-        dir.remove(1)
-
-    # 判断是否可以右转
-    dir.append(3)
-    if cur_roads_list[right_index] != -1:
-        channel_top_car = []
-        if cur_roads_list[left_index] != -1:  # 保证左边有车道
-            if road_out[left_index] <= road_info[cur_roads_list[left_index]][-1]:
-                for temp_channel in road_map[cur_roads_list[left_index]][road_out[left_index]]:
-                    channel_top_car += temp_channel[:1]  # 取出每个车道的最前面一辆车判断是否发生冲突
-                for temp_car in channel_top_car:
-                    if temp_car.state == 1:
-                        if get_car_direction(temp_car, cur_cross_num, cross_map, answer_map) == 2:
-                            dir.remove(3)
-                            break
-        if cur_roads_list[direct_index] != -1 and (3 in dir):
-            if road_out[direct_index] <= road_info[cur_roads_list[direct_index]][-1]:
-                channel_top_car = []
-                temp_dir = []
-                for temp_channel in road_map[cur_roads_list[direct_index]][road_out[direct_index]]:
-                    channel_top_car += temp_channel[:1]  # 取出每个车道的最前面一辆车判断是否发生冲突
-                for temp_car in channel_top_car:
-                    if temp_car.state == 1:
-                        temp_dir.append(get_car_direction(temp_car, cur_cross_num, cross_map, answer_map))
-                if (2 not in temp_dir) and (1 in temp_dir):
-                    dir.remove(3)
+                break
+            road_map.car_state[car] = 0  # 车辆到达终止状态
+            stop_num += 1
+        prev = car
+    return stop_num
+
+
+def get_car_direction(car, road_map: RoadState, route_steps: RouteSteps) -> int:
+    "车辆在前方路口的转向，1表示左转，2表示直行，3表示右转"
+    return route_steps.turn[road_map.car_step[car]]
+
+
+def build_cross_topology(cross_map: dict) -> dict:
+    """
+    根据cross.txt生成每个路口的静态拓扑表，只计算一次
+    topology[(cross, road)]为从road驶入路口后的list((转向, 驶出道路, 冲突列表))，按直行、左转、右转排列;
+    冲突列表为list((驶入道路, 转向))，这些道路上优先级最高的车按该转向行驶时本车不能通过
+    """
+    topology = dict()
+    for cur_cross_num, cur_roads_list in cross_map.items():
+        for cur_index, cur_road_num in enumerate(cur_roads_list):
+            if cur_road_num == -1:
+                continue
+            left_road = cur_roads_list[(cur_index + 1) % 4]
+            direct_road = cur_roads_list[(cur_index + 2) % 4]
+            right_road = cur_roads_list[(cur_index + 3) % 4]
+            turns = [(2, direct_road, ())]  # 直行(包括到达终点)优先级最高，总是可以通过
+            if left_road != -1:
+                # 左转: 右边道路的车直行时冲突
+                turns.append((1, left_road, tuple((road, 2) for road in [right_road] if road != -1)))
+            if right_road != -1:
+                # 右转: 左边道路的车直行或对面道路的车左转时冲突
+                turns.append((3, right_road, tuple(conflict for conflict in [(left_road, 2), (direct_road, 1)]
+                                                   if conflict[0] != -1)))
+            topology[(cur_cross_num, cur_road_num)] = turns
+    return topology
+
+
+def get_blocking_road(cur_cross_num: int, cur_road_num: int, dir: int, cross_topology: dict, head_dir: dict) -> int:
+    """
+    获取按转向dir通过路口时，因转向冲突而必须先让行的道路
+    :param head_dir: head_dir[(cross, road)]为道路上驶向该路口、优先级最高的等待车辆的转向
+    :return: 冲突的道路，没有冲突时返回-1
+    """
+    for turn, _, conflicts in cross_topology[(cur_cross_num, cur_road_num)]:
+        if turn != dir:
+            continue
+        for road, conflict_turn in conflicts:
+            if head_dir.get((cur_cross_num, road)) == conflict_turn:
+                return road
+        return -1
+    return cur_road_num  # 路口不允许该转向，车辆永远不能通过
+
+
+class DeadlockError(Exception):
+    """
+    调度死锁，cycle为环上的list((路口, 道路, 车辆id))，
+    表示道路上驶向该路口的车辆在等待下一个元素中的车辆
+    """
+
+    def __init__(self, cycle):
+        self.cycle = cycle
+        self.crosses = [cross for cross, _, _ in cycle]
+        self.roads = [road for _, road, _ in cycle]
+        self.car_ids = [car_id for _, _, car_id in cycle]
+        super().__init__('死锁: ' + ' -> '.join('路口{} 道路{} 车辆{}'.format(*temp) for temp in cycle))
+
+
+class WaitForGraph:
+    """
+    路口等待图，节点为(路口, 驶入路口的道路)，即该道路上驶向路口、优先级最高的等待车辆
+    edge[node] = (target, car, via_road): node的车辆在等待target的车辆，
+    via_road为-1表示转向冲突，否则表示被道路via_road上等待的车挡住
+    每个节点最多一条出边，节点的车辆通过路口或其等待的道路上驶入新车时删除相关的边
+    """
+
+    def __init__(self):
+        self.edge = dict()
+        self.waiters = dict()  # target --> set(等待target的节点)
+
+    def add(self, node, target, car, via_road):
+        """
+        添加一条等待边
+        :return: 形成环时返回环上的节点list，从node开始，否则返回None
+        """
+        self.remove(node)
+        self.edge[node] = (target, car, via_road)
+        self.waiters.setdefault(target, set()).add(node)
+        cycle = [node]
+        cur = target
+        while cur != node:
+            if cur not in self.edge or cur in cycle:
+                return None
+            cycle.append(cur)
+            cur = self.edge[cur][0]
+        return cycle
+
+    def remove(self, node):
+        "删除node的出边"
+        if node in self.edge:
+            self.waiters[self.edge.pop(node)[0]].discard(node)
+
+    def release(self, node):
+        "node的状态发生变化，删除node的出边以及等待node的所有边，这些节点需要重新判断"
+        self.remove(node)
+        for waiter in self.waiters.pop(node, ()):
+            del self.edge[waiter]
+
+    def find_cycle(self):
+        "所有节点都有出边时找出一个环"
+        for start in self.edge:
+            path = []
+            cur = start
+            while cur in self.edge and cur not in path:
+                path.append(cur)
+                cur = self.edge[cur][0]
+            if cur in path:
+                return path[path.index(cur):]
+        return None
+
+
+def is_closed_cycle(cycle, wait_for: WaitForGraph, wait_count: dict) -> bool:
+    """
+    判断等待环是否一定是死锁
+    转向冲突只有在冲突道路的车辆通过后才会解除; 被下一条路上等待的车挡住时，
+    同一路口其他道路的车驶入下一条路后也可能解除，所以要求这些路口所有有等待车辆的道路都在环上
+    """
+    nodes = set(cycle)
+    for cross, road in cycle:
+        if wait_for.edge[(cross, road)][2] == -1:
+            continue
+        for other_road, n in wait_count.get(cross, dict()).items():
+            if n and (cross, other_road) not in nodes:
+                return False
+    return True
+
+
+def raise_deadlock(cycle, wait_for: WaitForGraph, road_map):
+    raise DeadlockError([(cross, road, int(road_map.car_id[wait_for.edge[(cross, road)][1]])) for cross, road in cycle])
+
+
+def update_head_dir(cur_cross_num, cur_road_num, road_map, road_info, route_steps, head_dir):
+    "道路上的车辆通过路口后，更新该道路优先级最高的等待车辆的转向"
+    car = get_car_from_road(cur_road_num, cur_cross_num, road_map, road_info)
+    if car < 0:
+        head_dir.pop((cur_cross_num, cur_road_num), None)
     else:
-        dir.remove(3)
-    return dir
-
-
-def get_in_road(cur_cross: int, cur_road: int, dir: int, cross_map: dict, road_map: dict):
-    cross_road_list = cross_map[cur_cross][:]
-    cur_index = cross_road_list.index(cur_road)
-    in_road_index = (cur_index + dir) % 4
-    in_road_number = cross_road_list[in_road_index]
-    # 双向车道，判断是走正还是反
-    is_reverse = 0 if in_road_index < 2 else 1
-    in_road = road_map[in_road_number][is_reverse]
-    return in_road, in_road_number, is_reverse
-
-
-def one_second(road_info, road_map, answer_map, cross_map):
-    wait_cars = []
-    stop_cars = []
-    for cur_road_num in road_map:
-        for cur_dir_road in road_map[cur_road_num]:
-            for cur_channel in cur_dir_road:
-                wait_car, stop_car = drive_car_in_road_to_end(cur_road_num, cur_channel, answer_map, state=0)
-                wait_cars += wait_car
-                stop_cars += stop_car
-
-    # 如果道路上的等待车辆加停止车辆数量总和为0，则表示完成整个调度过程
-    if len(wait_cars + stop_cars) == 0:
+        head_dir[(cur_cross_num, cur_road_num)] = get_car_direction(car, road_map, route_steps)
+
+
+def get_in_road(car, road_map: RoadState, route_steps: RouteSteps):
+    "车辆通过路口后驶入的道路，以及该道路上与行驶方向一致的车道"
+    step = road_map.car_step[car]
+    in_road_number = route_steps.next_road[step]
+    in_lanes = road_map.road_lanes[(in_road_number, route_steps.is_reverse[step + 1])]
+    return in_lanes, in_road_number
+
+
+def one_second(road_info, road_map, route_steps, cross_topology, profiler=None):
+    """
+    调度一个时间片内道路上的所有车辆
+    等待车辆按(路口, 驶入路口的道路)分别计数，只处理有等待车辆的路口和道路
+    :param profiler: TickProfiler，记录车道内行驶和路口调度的耗时与等待车辆统计
+    :return: 0表示道路上已经没有车辆
+    """
+    if profiler is not None:
+        start = perf_counter()
+    # wait_count[cross][road]表示道路road上驶向路口cross、处于等待状态的车辆数
+    has_car, wait_count = drive_lanes_to_end(road_map, route_steps)
+    sum_wait = sum(n for cross_wait in wait_count.values() for n in cross_wait.values())
+    if profiler is not None:
+        profiler.lanes_done(perf_counter() - start, wait_count)
+        start = perf_counter()
+
+    # 道路上没有车辆，表示完成整个调度过程
+    if not has_car:
+        if profiler is not None:
+            profiler.cross_done(perf_counter() - start, 0, 0)
         return 0
-    sum_wait = -1
-    while wait_cars:
-        if len(wait_cars) == sum_wait and sum_wait != 0:
-            raise Exception('死锁')
-        else:
-            sum_wait = len(wait_cars)
-        for cur_cross_num in cross_map:
-            cross_road_list = list(filter(lambda x: x != -1, cross_map[cur_cross_num][:]))
-            cross_road_list.sort()
-            for cur_road_num in cross_road_list:
-                road_wait_car = []
-                for temp in wait_cars:
-                    if temp.cur_road_num == cur_road_num and road_info[cur_road_num][4 - temp.is_reverse] == cur_cross_num:
-                        road_wait_car.append(temp)
-                dir_list = get_road_direction(cur_cross_num, cur_road_num, cross_map, road_map, answer_map, road_info)
-                sum_wait_road = -1
-                while road_wait_car:
-                    if len(road_wait_car) == sum_wait_road and sum_wait_road != 0:
-                        raise Exception('死锁{} {}'.format(cur_cross_num, cur_road_num))
-                    else:
-                        sum_wait_road = len(road_wait_car)
-                    dir, car = get_car_from_road(cur_road_num, cur_cross_num, road_map, cross_map, answer_map, dir_list)
-                    if car.id == 10240:
-                        print('this')
-                    in_road, next_road_num, is_reverse = get_in_road(cur_cross_num, cur_road_num, dir, cross_map, road_map)
-                    if in_road[-1] and in_road[-1][-1].s1 >= in_road[-1][-1].road_length - 1:
+    head_dir = dict()
+    for cur_cross_num in wait_count:
+        for cur_road_num in wait_count[cur_cross_num]:
+            update_head_dir(cur_cross_num, cur_road_num, road_map, road_info, route_steps, head_dir)
+    wait_for = WaitForGraph()
+    sweeps = iterations = 0
+    while sum_wait:
+        last_wait = sum_wait
+        sweeps += 1
+        for cur_cross_num in sorted(wait_count):
+            cross_wait = wait_count[cur_cross_num]
+            for cur_road_num in sorted(cross_wait):
+                while cross_wait[cur_road_num]:
+                    iterations += 1
+                    node = (cur_cross_num, cur_road_num)
+                    car = get_car_from_road(cur_road_num, cur_cross_num, road_map, road_info)
+                    block_road = get_blocking_road(cur_cross_num, cur_road_num, head_dir[node], cross_topology,
+                                                   head_dir)
+                    if block_road != -1:
+                        # 转向冲突，等待冲突道路上的车先通过
+                        cycle = wait_for.add(node, (cur_cross_num, block_road), car, -1)
+                        if cycle and is_closed_cycle(cycle, wait_for, wait_count):
+                            raise_deadlock(cycle, wait_for, road_map)
                         break
-                    channel = car.getChannel(in_road)
-                    old_channel = car.moveToNextRoad(channel, next_road_num, is_reverse, road_info)
-                    try:
-                        road_wait_car.remove(car)
-                    except:
-                        print('s')
-                    wait_cars.remove(car)
-
-                    stop_cars = drive_car_in_road_to_end(cur_road_num, old_channel, answer_map, state=1)[1]
-                    for temp in stop_cars:
-                        road_wait_car.remove(temp)
-                        wait_cars.remove(temp)
+                    if route_steps.is_last[road_map.car_step[car]]:
+                        # 到达终点
+                        old_lane = int(road_map.car_lane[car])
+                        road_map.popleft(old_lane)
+                        road_map.finish(car)
+                    else:
+                        in_lanes, next_road_num = get_in_road(car, road_map, route_steps)
+                        next_node = (int(road_map.lane_cross[in_lanes[0]]), next_road_num)
+                        old_lane, moved = move_to_next_road(road_map, car, in_lanes, next_road_num, road_info)
+                        if not moved:
+                            # 被下一条路上等待的车挡住
+                            cycle = wait_for.add(node, next_node, car, next_road_num)
+                            if cycle and is_closed_cycle(cycle, wait_for, wait_count):
+                                raise_deadlock(cycle, wait_for, road_map)
+                            break
+                        if road_map.car_lane[car] != old_lane:
+                            wait_for.release(next_node)
+                    wait_for.release(node)
+                    stop_num = drive_car_in_road_to_end(road_map, old_lane, route_steps)
+                    cross_wait[cur_road_num] -= stop_num + 1
+                    sum_wait -= stop_num + 1
+                    update_head_dir(cur_cross_num, cur_road_num, road_map, road_info, route_steps, head_dir)
+                if not cross_wait[cur_road_num]:
+                    del cross_wait[cur_road_num]
+            if not cross_wait:
+                del wait_count[cur_cross_num]
+        if sum_wait == last_wait:
+            # 一轮调度没有车辆移动时，每个有等待车辆的道路都有出边，一定存在环
+            raise_deadlock(wait_for.find_cycle(), wait_for, road_map)
+    if profiler is not None:
+        profiler.cross_done(perf_counter() - start, sweeps, iterations)
     return 1
 
-def drive_car_into_road(cur_time_step, car_map, answer_map, road_info, cross_map, answer_road_path):
-    # 找到这个时间出发的车放在cars_ready中
-    i = 0
-    for i in range(len(answer_road_path)):
-        if answer_road_path[i][1] != cur_time_step:
-            break
-        else:
-            i += 1
-    cars_ready, answer_road_path = answer_road_path[:i], answer_road_path[i:]
-
-    # 按照出发路段和车辆id进行排序上路，不能上路的放在delay_cars中
-    cars_ready.sort(key=lambda x: (x[2], x[0]))
-    delay_cars = []
-    for temp_car in cars_ready:
-        car_id = temp_car[0]
-        start_road = temp_car[2]
+
+class DepartureQueue:
+    """
+    车辆出发队列
+    calendar: 还没到出发时间的车辆，按(出发时间, 出发道路, 车辆id)排列的堆;
+    garage[(道路, 方向)]: 已经到出发时间、等待上路的车辆，按车辆id排列的堆，
+    上路时只影响出发道路的车道，所以不同车库之间的处理顺序不影响结果
+    depart_time[car_id]: 车辆实际上路的时间
+    """
+
+    def __init__(self, answer_road_path, route_steps):
+        self.calendar = [(temp[1], temp[2], temp[0]) for temp in answer_road_path]
+        heapify(self.calendar)
+        self.garage = dict()
+        self.depart_time = dict()
+        self.route_steps = route_steps
+
+    def __len__(self):
+        return len(self.calendar) + sum(len(cars) for cars in self.garage.values())
+
+    def fork(self):
+        "复制出一个独立的出发队列，路线共享"
+        departures = copy.copy(self)
+        departures.calendar = list(self.calendar)
+        departures.garage = {key: list(cars) for key, cars in self.garage.items()}
+        departures.depart_time = dict(self.depart_time)
+        return departures
+
+    def pending(self, cur_time_step):
+        """
+        还没有上路的车辆，车库中的车辆出发时间记为cur_time_step
+        :return: (出发时间数组, 车辆id数组)
+        """
+        pending = [(start_time, car_id) for start_time, _, car_id in self.calendar]
+        pending += [(cur_time_step, car_id) for cars in self.garage.values() for car_id in cars]
+        pending = np.array(pending, dtype=np.int64).reshape(-1, 2)
+        return pending[:, 0], pending[:, 1]
+
+    def release(self, cur_time_step):
+        "把出发时间不晚于cur_time_step的车辆放入出发道路的车库"
+        route_steps = self.route_steps
+        while self.calendar and self.calendar[0][0] <= cur_time_step:
+            _, start_road, car_id = heappop(self.calendar)
+            key = (start_road, route_steps.is_reverse[route_steps.first[car_id]])
+            heappush(self.garage.setdefault(key, []), car_id)
+
+
+def drive_car_into_road(cur_time_step, car_map, route_steps, road_info, road_map, departures: DepartureQueue,
+                        profiler=None):
+    """
+    安排到出发时间的车辆上路，每个车库按车辆id依次上路
+    车道能否进入与车速无关，一辆车不能上路时同一车库后面的车也不能上路，留在车库中推迟到下一时刻
+    :param profiler: TickProfiler，记录上路的耗时并结束本时刻的统计
+    :return: 本时刻上路的车辆数
+    """
+    if profiler is not None:
+        start = perf_counter()
+    departures.release(cur_time_step)
+    depart_num = 0
+    for (start_road, is_reverse), cars in list(departures.garage.items()):
         len_road = road_info[start_road][0]
-        v_lim = min(road_info[start_road][1], car_map[car_id][2])
-        cross_id = car_map[car_id][0]
-        is_reverse = cross_map[cross_id].index(start_road) // 2
-
-        in_road = road_map[start_road][is_reverse]
-        # 如果不能安排上车
-        if in_road[-1] and in_road[-1][-1].s1 == in_road[-1][-1].road_length - 1:
-            temp_car[1] += 1
-            answer_map[car_id][0] += 1
-            delay_cars.append(temp_car)
-        else:
-            for i in range(len(in_road)):
-                if in_road[i] == [] or len_road - in_road[i][-1].s1 > v_lim:
-                    car = Car(id=car_id, v_lim=v_lim, s1=len_road - v_lim,
-                              length=len_road, channel=in_road[i], cur_road_num=start_road, is_reverse=is_reverse)
-                    in_road[i].append(car)
-                    break
-                elif in_road[i][-1].s1 != len_road - 1:
-                    s1 = in_road[i][-1].s1
-                    car = Car(id=car_id, v_lim=v_lim, s1=s1 + 1, length=len_road,
-                              channel=in_road[i], cur_road_num=start_road, is_reverse=is_reverse)
-                    in_road[i].append(car)
-                    break
-    return delay_cars + answer_road_path
-
-
-def check_road(road_map):
+        lanes = road_map.road_lanes[(start_road, is_reverse)]
+        while cars:
+            car_id = cars[0]
+            car = road_map.car_index[car_id]
+            v_lim = min(road_info[start_road][1], car_map[car_id][2])
+            for lane in lanes:
+                last = road_map.last(lane)
+                if last < 0 or len_road - road_map.car_s1[last] > v_lim:
+                    s1 = len_road - v_lim
+                elif road_map.car_s1[last] != len_road - 1:
+                    s1 = int(road_map.car_s1[last]) + 1
+                else:
+                    continue
+                break
+            else:
+                # 所有车道的最后一个位置都有车，推迟到下一时刻出发
+                break
+            heappop(cars)
+            road_map.car_s1[car] = s1
+            road_map.car_v[car] = v_lim
+            road_map.car_state[car] = 0
+            road_map.car_step[car] = route_steps.first[car_id]
+            road_map.append(lane, car)
+            departures.depart_time[car_id] = cur_time_step
+            depart_num += 1
+        if not cars:
+            del departures.garage[(start_road, is_reverse)]
+    if profiler is not None:
+        profiler.departures_done(perf_counter() - start, depart_num)
+    return depart_num
+
+
+def _route_first(car_ids, route_steps):
+    "每辆车在路线中第一步的下标，不在路线中的车为0"
+    return np.array([route_steps.first.get(car_id, 0) for car_id in car_ids.tolist()], dtype=np.int64)
+
+
+def save_state(path, time_step, road_map: RoadState, departures: DepartureQueue, route_steps: RouteSteps):
+    """
+    保存仿真状态，每个数组保存为目录path下的一个.npy文件，可以用np.load(mmap_mode)直接映射
+    车辆的路线步数按相对于路线起点的偏移保存，恢复时可以换成只修改了部分车辆后续路线的RouteSteps
+    :param time_step: 已经完成调度的时刻
+    """
+    os.makedirs(path, exist_ok=True)
+    arrays = {name: getattr(road_map, name) for name in RoadState.STATIC + RoadState.MUTABLE}
+    arrays['car_step'] = road_map.car_step - _route_first(road_map.car_id, route_steps)
+    arrays['pending_time'], arrays['pending_car'] = departures.pending(time_step)
+    arrays['depart_car'] = np.array(list(departures.depart_time.keys()), dtype=np.int64)
+    arrays['depart_time'] = np.array(list(departures.depart_time.values()), dtype=np.int64)
+    arrays['time_step'] = np.array(time_step, dtype=np.int64)
+    for name, value in arrays.items():
+        np.save(os.path.join(path, name + '.npy'), value)
+
+
+def load_state(path, route_steps: RouteSteps, mmap_mode='c'):
+    """
+    恢复save_state保存的仿真状态
+    :param route_steps: 继续仿真使用的路线，已经上路的车辆走过的部分需要与保存时一致
+    :param mmap_mode: 默认'c'为写时复制的内存映射，修改只发生在内存中，不会写回文件
+    :return: (time_step, road_map, departures)
+    """
+    arrays = dict()
+    for name in RoadState.STATIC + RoadState.MUTABLE + ('pending_time', 'pending_car', 'depart_car', 'depart_time',
+                                                        'time_step'):
+        arrays[name] = np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+    arrays['car_step'] = arrays['car_step'] + _route_first(arrays['car_id'], route_steps)
+    road_map = RoadState.from_arrays(arrays)
+
+    pending = [[car_id, start_time, route_steps.road[route_steps.first[car_id]]]
+               for start_time, car_id in zip(arrays['pending_time'].tolist(), arrays['pending_car'].tolist())]
+    departures = DepartureQueue(pending, route_steps)
+    departures.depart_time = dict(zip(arrays['depart_car'].tolist(), arrays['depart_time'].tolist()))
+    return int(arrays['time_step']), road_map, departures
+
+
+def check_road(road_map: RoadState):
     res_car = []
-    for temp_road in road_map:  # 对车道数进行遍历
-        for i in range(len(road_map[temp_road])):  # 对单双向道路进行遍历
-            for j in range(len(road_map[temp_road][i])):  # 对道路中的channel数进行遍历
-                for temp in road_map[temp_road][i][j]:  # 对channel中的车辆进行遍历
-                    if i == 0:
-                        res = 'Forward '
-                    else:
-                        res = 'Reverse '
-                    res += 'id:{} '.format(temp.id)
-                    res += 'road:{} '.format(temp_road)
-                    res += 'channel:{} '.format(j + 1)
-                    res += 'cur_pos:{} '.format(temp.road_length - temp.s1)
-                    res += 'state:{} '.format(temp.state)
-                    res += 'v:{}'.format(temp.v_lim)
-                    res_car.append(res)
+    # 只遍历有车的车道，车道编号按(道路, 方向, channel)的顺序排列
+    for lane in sorted(road_map.active):
+        temp_road, i = int(road_map.lane_road[lane]), int(road_map.lane_dir[lane])
+        j = lane - road_map.road_lanes[(temp_road, i)].start
+        for temp in road_map.lane_cars(lane):  # 对channel中的车辆进行遍历
+            if i == 0:
+                res = 'Forward '
+            else:
+                res = 'Reverse '
+            res += 'id:{} '.format(road_map.car_id[temp])
+            res += 'road:{} '.format(temp_road)
+            res += 'channel:{} '.format(j + 1)
+            res += 'cur_pos:{} '.format(road_map.lane_len[lane] - road_map.car_s1[temp])
+            res += 'state:{} '.format(road_map.car_state[temp])
+            res += 'v:{}'.format(road_map.car_v[temp])
+            res_car.append(res)
     return res_car
 
 
-def update_adjacent_matrix(road):
+def load_answer_road_path(answer_path):
+    "读取answer文件或save_plan保存的二进制方案目录，返回list(id, StartTime, road1, road2 ...)"
+    return csr_to_answer(*read_plan(answer_path))
+
+
+def simulate(answer_road_path, carData, roadData, crossData, max_ticks=0, best_time=None, profiler=None,
+             timeout=0, progress=None):
     """
-    根据现在的状态更新权值矩阵
-    :return:
+    对一个方案进行完整的调度
+    :param max_ticks: 最多调度的时刻数，0表示不限制
+    :param best_time: 返回目前最好的调度时间的函数(0表示还没有)，本方案已经不可能更好时提前结束
+    :param profiler: TickProfiler，记录每个时刻的统计
+    :param timeout: 调度的最长时间(秒)，超时后提前结束，0表示不限制
+    :param progress: 每个时刻结束时调用 progress(time_step)
+    :return: (调度时间, 所有车辆的总调度时间, 是否死锁, 调度的时刻数, 是否提前结束)
+    没有调度完成时调度时间为-1，总调度时间按还没到达的车辆到当前时刻为止计算
     """
-    pass
+    road_map, road_info, _, cross_map, car_map = generate_road_map(roadData, crossData, carData, answer_road_path)
+    route_steps = compile_routes(answer_road_path, roadData, crossData, carData)
+    cross_topology = build_cross_topology(cross_map)
+    departures = DepartureQueue(answer_road_path, route_steps)
+    arrive_time = np.zeros(len(carData), dtype=np.int64)
+
+    schedule_time, deadlock, aborted = -1, False, False
+    deadline = perf_counter() + timeout if timeout else None
+    time_step = 0
+    while not max_ticks or time_step < max_ticks:
+        time_step += 1
+        if profiler is not None:
+            profiler.begin(time_step, road_map)
+        try:
+            if not one_second(road_info, road_map, route_steps, cross_topology, profiler) and not departures:
+                schedule_time = time_step - 1
+                break
+        except DeadlockError:
+            deadlock = True
+            break
+        arrive_time[(road_map.car_state == 2) & (arrive_time == 0)] = time_step
+        drive_car_into_road(time_step, car_map, route_steps, road_info, road_map, departures, profiler)
+        # 还有车辆没有到达，调度时间至少为time_step + 1
+        if best_time is not None and 0 < best_time() <= time_step:
+            aborted = True
+            break
+        if progress is not None:
+            progress(time_step)
+        if deadline is not None and perf_counter() > deadline:
+            aborted = True
+            break
 
+    if profiler is not None:
+        profiler.flush()
+    end_time = np.where(arrive_time > 0, arrive_time, time_step)
+    car_time = int(np.maximum(end_time - carData.planTime, 0).sum())
+    return schedule_time, car_time, deadlock, time_step, aborted
 
-if __name__ == '__main__':
-    answer_path = r'D:\Users\yyh\Pycharm_workspace\leetcode\answer.txt'
-    road_path = r'D:\Users\yyh\Pycharm_workspace\leetcode\road.txt'
-    car_path = r'D:\Users\yyh\Pycharm_workspace\leetcode\car.txt'
-    cross_path = r'D:\Users\yyh\Pycharm_workspace\leetcode\cross.txt'
 
+# evaluate_plans的结果表，每行对应一个方案
+PLAN_RESULT_DTYPE = np.dtype([('plan', np.int64), ('schedule_time', np.int64), ('car_time', np.int64),
+                              ('deadlock', bool), ('ticks', np.int64), ('aborted', bool)])
+
+_worker_tables = None
+_worker_shms = []
+_worker_best = None
+
+
+def _init_evaluator(specs, best):
+    "子进程初始化，挂载共享内存中的car/road/cross数据，按结构化数组直接查看，不复制"
+    global _worker_tables, _worker_best
+    tables = []
+    for spec, table_type in zip(specs, (CarTable, RoadTable, CrossTable)):
+        shm, arr = attach_array(spec)
+        _worker_shms.append(shm)
+        tables.append(table_type(arr.view(table_type.dtype)[:, 0]))
+    _worker_tables = tables
+    _worker_best = best
+
+
+def _best_time():
+    return _worker_best.value
+
+
+def _evaluate_plan(answer_path, max_ticks, early_abort):
+    "子进程中调度一个方案，调度完成时更新共享的最好调度时间"
+    carData, roadData, crossData = _worker_tables
+    result = simulate(load_answer_road_path(answer_path), carData, roadData, crossData, max_ticks,
+                      _best_time if early_abort else None)
+    if result[0] >= 0:
+        with _worker_best.get_lock():
+            if not _worker_best.value or result[0] < _worker_best.value:
+                _worker_best.value = result[0]
+    return result
+
+
+def evaluate_plans(answer_paths, car_path, road_path, cross_path, workers=1, max_ticks=0, early_abort=True):
+    """
+    批量评估多个answer方案，car/road/cross只读取一次，放在共享内存中供所有进程只读使用
+    :param answer_paths: answer文件路径list
+    :param workers: 进程数，1表示在当前进程中依次调度
+    :param max_ticks: 每个方案最多调度的时刻数，可以是整数或与answer_paths对应的list，0表示不限制
+    :param early_abort: 调度时刻已经超过目前最好的调度时间时提前结束该方案
+    :return: PLAN_RESULT_DTYPE结构化数组
+    """
+    if np.isscalar(max_ticks):
+        max_ticks = [max_ticks] * len(answer_paths)
+    tables = read_data(car_path, road_path, cross_path)
+    best = multiprocessing.Value('q', 0)
+    results = np.zeros(len(answer_paths), dtype=PLAN_RESULT_DTYPE)
+    results['plan'] = np.arange(len(answer_paths))
+
+    if workers <= 1:
+        global _worker_tables, _worker_best
+        _worker_tables, _worker_best = tables, best
+        for k, (answer_path, ticks) in enumerate(zip(answer_paths, max_ticks)):
+            results[k] = (k,) + _evaluate_plan(answer_path, ticks, early_abort)
+        return results
+
+    shms, specs = [], []
+    try:
+        for table in tables:
+            shm, spec = share_array(np.ascontiguousarray(table.values, dtype=np.int64))
+            shms.append(shm)
+            specs.append(spec)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_evaluator,
+                                 initargs=(specs, best)) as executor:
+            futures = [executor.submit(_evaluate_plan, answer_path, ticks, early_abort)
+                       for answer_path, ticks in zip(answer_paths, max_ticks)]
+            for k, future in enumerate(futures):
+                results[k] = (k,) + future.result()
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+    return results
+
+
+def run_simulation(answer_path, car_path, road_path, cross_path, max_ticks=0, timeout=0, profiler=None,
+                   progress=None):
+    """
+    读取文件并调度一个方案，可以在其他脚本中直接调用
+    :param answer_path: answer文件或save_plan保存的方案目录
+    :param max_ticks: 最多调度的时刻数，0表示不限制
+    :param timeout: 调度的最长时间(秒)，0表示不限制
+    :return: dict(schedule_time, car_time, deadlock, ticks, aborted, seconds, ticks_per_second)
+    schedule_time为总调度时间，没有调度完成时为-1; car_time为所有车辆的总调度时间(车辆*时刻)
+    """
     carData, roadData, crossData = read_data(car_path, road_path, cross_path)
+    answer_road_path = load_answer_road_path(answer_path)
+    start = perf_counter()
+    schedule_time, car_time, deadlock, ticks, aborted = simulate(answer_road_path, carData, roadData, crossData,
+                                                                 max_ticks, profiler=profiler, timeout=timeout,
+                                                                 progress=progress)
+    seconds = perf_counter() - start
+    return dict(schedule_time=schedule_time, car_time=car_time, deadlock=deadlock, ticks=ticks, aborted=aborted,
+                seconds=seconds, ticks_per_second=ticks / seconds if seconds else 0.0)
 
-    ###############################################################
-    with open(answer_path) as f:
-        answer_road_path = []
-        head = f.readline()[2: -2].split(',')
-        line = f.readline()
-        while line:
-            line = line.strip('(').strip('\n').strip(')').split(",")
-            answer_road_path.append(list(map(int, line)))
-            line = f.readline()
-    answer_road_path.sort(key=lambda x: x[1])
-    ################################################################
-
-
-    cross_road_map, adjacent_matrix, edges = create_road_between_cross_graph(roadData, crossData)
-    # answer_node_path = generate_cross_path(carData, edges)
-    # answer_road_path = generate_answer(answer_node_path, cross_road_map)
-    # answer_road_path = update_departure_time(answer_road_path)
-    # write_answer_file(answer_road_path, answer_path)
-
-
-    # 下面是新增的代码
-    road_map, road_info, answer_map, cross_map, car_map = generate_road_map(roadData,
-                                                                            crossData,
-                                                                            carData,
-                                                                            answer_road_path)
-    time_step = 1
-
-    print(check_road(road_map))
-    print(time_step)
-    answer_road_path = drive_car_into_road(time_step, car_map, answer_map,
-                                           road_info, cross_map, answer_road_path)
-
-    one_second(road_info, road_map, answer_map, cross_map)
-    answer_road_path = drive_car_into_road(time_step, car_map, answer_map, road_info, cross_map, answer_road_path)
-
-    one_second(road_info, road_map, answer_map, cross_map)
-    answer_road_path = drive_car_into_road(time_step, car_map, answer_map, road_info, cross_map, answer_road_path)
-
-    one_second(road_info, road_map, answer_map, cross_map)
-    answer_road_path = drive_car_into_road(time_step, car_map, answer_map, road_info, cross_map, answer_road_path)
-
-    while one_second(road_info, road_map, answer_map, cross_map):
-        answer_road_path = drive_car_into_road(time_step, car_map, answer_map, road_info, cross_map, answer_road_path)
-        time_step += 1
-        print(time_step)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='调度answer方案，输出总调度时间等统计')
+    parser.add_argument('car_path')
+    parser.add_argument('road_path')
+    parser.add_argument('cross_path')
+    parser.add_argument('answer_path', help='answer文件或save_plan保存的方案目录')
+    parser.add_argument('--max-ticks', type=int, default=0, help='最多调度的时刻数，0表示不限制')
+    parser.add_argument('--timeout', type=float, default=0, help='调度的最长时间(秒)，0表示不限制')
+    parser.add_argument('--progress', type=int, default=0, help='每隔多少个时刻输出一次进度，0表示不输出')
+    parser.add_argument('--trace', help='逐时刻统计的保存路径，.npz或.csv')
+    args = parser.parse_args()
+
+    progress = None
+    if args.progress > 0:
+        def progress(time_step):
+            if time_step % args.progress == 0:
+                print('time_step: {}'.format(time_step), file=sys.stderr)
+    profiler = TickProfiler() if args.trace else None
+    summary = run_simulation(args.answer_path, args.car_path, args.road_path, args.cross_path, args.max_ticks,
+                             args.timeout, profiler, progress)
+    if profiler is not None:
+        profiler.save(args.trace)
+    for name in ('schedule_time', 'car_time', 'ticks', 'deadlock', 'aborted'):
+        print('{}: {}'.format(name, summary[name]))
+    print('seconds: {:.3f}'.format(summary['seconds']))
+    print('ticks_per_second: {:.1f}'.format(summary['ticks_per_second']))
+    sys.exit(0 if summary['schedule_time'] >= 0 else 1)
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+
+"""
+@File    :   benchmark.py
+@Desc    :   规划器和调度器的性能测试;
+             按给定的大小和随机种子生成网格地图和车辆，写成与car/road/cross相同的文本格式，
+             分阶段计时，统计吞吐量和内存峰值，并与保存的基线JSON比较
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import back_propagation
+from data_io import read_data, write_txt, write_answer
+from departure_schedule import schedule_departures
+from road_graph import create_road_between_cross_graph
+
+CAR_HEAD = ['id', 'from', 'to', 'speed', 'planTime']
+ROAD_HEAD = ['id', 'length', 'speed', 'channel', 'from', 'to', 'isDuplex']
+CROSS_HEAD = ['id', 'roadId', 'roadId', 'roadId', 'roadId']
+
+
+def _load_planner():
+    "CodeCraft-2019.py的文件名不能直接import，按路径加载"
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'CodeCraft-2019.py')
+    spec = importlib.util.spec_from_file_location('codecraft', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def generate_map(rows, cols, seed=0, duplex_ratio=1.0, channels=(1, 2, 3, 4, 5), speeds=(4, 6, 8),
+                 lengths=(10, 12, 15, 18, 20)):
+    """
+    生成rows*cols的网格地图，路口id为 行*cols + 列 + 1，道路id从5000开始
+    外圈道路都是双向的，内部道路按duplex_ratio随机为双向，
+    单向道路按行、列的奇偶交替方向，保证任意两个路口之间都可达
+    :param channels/speeds/lengths: 道路的车道数、限速、长度从中均匀随机选取
+    :return: (road, cross) 与road.txt、cross.txt列顺序一致的二维数组
+    """
+    rng = np.random.default_rng(seed)
+    cross_id = np.arange(rows * cols).reshape(rows, cols) + 1
+    # 横向道路从(i, j)到(i, j + 1)，纵向道路从(i, j)到(i + 1, j)
+    h_from, h_to = cross_id[:, :-1].ravel(), cross_id[:, 1:].ravel()
+    v_from, v_to = cross_id[:-1, :].ravel(), cross_id[1:, :].ravel()
+    h_row = np.repeat(np.arange(rows), cols - 1)
+    v_col = np.tile(np.arange(cols), rows - 1)
+    h_border = (h_row == 0) | (h_row == rows - 1)
+    v_border = (v_col == 0) | (v_col == cols - 1)
+    road_from = np.concatenate((h_from, v_from))
+    road_to = np.concatenate((h_to, v_to))
+    n_road = len(road_from)
+    road_id = np.arange(n_road) + 5000
+
+    duplex = np.concatenate((h_border, v_border)) | (rng.random(n_road) < duplex_ratio)
+    # 单向道路: 奇数行向左，奇数列向上
+    flip = ~duplex & np.concatenate((h_row % 2 == 1, v_col % 2 == 1))
+    road_from, road_to = np.where(flip, road_to, road_from), np.where(flip, road_from, road_to)
+    road = np.stack((road_id, rng.choice(lengths, n_road), rng.choice(speeds, n_road), rng.choice(channels, n_road),
+                     road_from, road_to, duplex.astype(np.int64)), axis=1)
+
+    # 路口的道路按上、右、下、左排列，用原始的(未翻转)端点确定方向
+    slots = np.full((rows * cols, 4), -1, dtype=np.int64)
+    h_id, v_id = road_id[:len(h_from)], road_id[len(h_from):]
+    slots[h_from - 1, 1] = h_id
+    slots[h_to - 1, 3] = h_id
+    slots[v_from - 1, 2] = v_id
+    slots[v_to - 1, 0] = v_id
+    cross = np.concatenate((cross_id.reshape(-1, 1), slots), axis=1)
+    return road, cross
+
+
+def generate_cars(n_cars, n_cross, seed=0, speeds=(2, 4, 6, 8), plan_span=10):
+    """
+    生成车辆，出发路口和终点路口不同，planTime在[1, plan_span]中均匀随机
+    :return: 与car.txt列顺序一致的二维数组
+    """
+    rng = np.random.default_rng([seed, 1])
+    car_from = rng.integers(1, n_cross + 1, n_cars)
+    # 终点在其余n_cross - 1个路口中选取
+    car_to = rng.integers(1, n_cross, n_cars)
+    car_to += car_to >= car_from
+    return np.stack((np.arange(n_cars) + 10000, car_from, car_to, rng.choice(speeds, n_cars),
+                     rng.integers(1, plan_span + 1, n_cars)), axis=1)
+
+
+def write_dataset(path, rows, cols, n_cars, seed=0, duplex_ratio=1.0, channels=(1, 2, 3, 4, 5),
+                  road_speeds=(4, 6, 8), car_speeds=(2, 4, 6, 8), plan_span=10):
+    """
+    生成地图和车辆，写入目录path下的car.txt、road.txt、cross.txt
+    :return: (car_path, road_path, cross_path)
+    """
+    os.makedirs(path, exist_ok=True)
+    road, cross = generate_map(rows, cols, seed, duplex_ratio, channels, road_speeds)
+    car = generate_cars(n_cars, rows * cols, seed, car_speeds, plan_span)
+    paths = tuple(os.path.join(path, name) for name in ('car.txt', 'road.txt', 'cross.txt'))
+    for file_path, head, values in zip(paths, (CAR_HEAD, ROAD_HEAD, CROSS_HEAD), (car, road, cross)):
+        write_txt(file_path, head, values)
+    return paths
+
+
+def _measure(func, memory, repeat=1):
+    """
+    运行repeat次，取最快的一次的耗时，memory为True时在tracemalloc下再运行一次统计内存峰值
+    :return: (第一次运行的结果, 秒数, 内存峰值MB，不统计时为None)
+    """
+    result, seconds = None, float('inf')
+    for k in range(max(repeat, 1)):
+        start = time.perf_counter()
+        value = func()
+        seconds = min(seconds, time.perf_counter() - start)
+        if not k:
+            result = value
+    peak = None
+    if memory:
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+    return result, seconds, peak
+
+
+def run_benchmarks(rows=8, cols=8, n_cars=10240, seed=0, duplex_ratio=1.0, channels=(1, 2, 3, 4, 5),
+                   road_speeds=(4, 6, 8), car_speeds=(2, 4, 6, 8), plan_span=10, batch_size=100, max_ticks=200,
+                   memory=True, data_dir=None, repeat=3):
+    """
+    生成数据后依次测试: 读取数据、建图、路径规划、生成answer、安排出发时间、写answer、调度
+    :param batch_size: 路径规划的批大小，与CodeCraft-2019.py的主程序一致，0表示静态规划
+    :param max_ticks: 调度的时刻数上限，0表示调度到结束
+    :param memory: 是否统计每个阶段的内存峰值，会让每个阶段多运行一次
+    :param data_dir: 数据目录，None时使用临时目录
+    :param repeat: 每个阶段运行的次数，耗时取最快的一次，减少偶然的波动
+    :return: dict(config, stages)，stages[阶段] = dict(seconds, peak_mb, rate, unit)
+    """
+    config = dict(rows=rows, cols=cols, n_cars=n_cars, seed=seed, duplex_ratio=duplex_ratio,
+                  channels=list(channels), road_speeds=list(road_speeds), car_speeds=list(car_speeds),
+                  plan_span=plan_span, batch_size=batch_size, max_ticks=max_ticks)
+    planner = _load_planner()
+    stages = dict()
+
+    def record(name, func, amount, unit):
+        result, seconds, peak = _measure(func, memory, repeat)
+        stages[name] = dict(seconds=seconds, peak_mb=peak, rate=amount(result) / seconds if seconds else 0.0,
+                            unit=unit)
+        return result
+
+    with tempfile.TemporaryDirectory() as tmp:
+        data_dir = data_dir or tmp
+        car_path, road_path, cross_path = write_dataset(data_dir, rows, cols, n_cars, seed, duplex_ratio, channels,
+                                                        road_speeds, car_speeds, plan_span)
+        carData, roadData, crossData = record('parse', lambda: read_data(car_path, road_path, cross_path),
+                                              lambda _: n_cars, 'cars/s')
+        _, _, edges = record('graph', lambda: create_road_between_cross_graph(roadData, crossData, dense=False),
+                             lambda _: len(roadData), 'roads/s')
+        answer_node_path = record('route', lambda: planner.generate_cross_path(carData, edges, batch_size=batch_size),
+                                  lambda _: n_cars, 'cars/s')
+        answer_road_path = record('answer', lambda: planner.generate_answer(answer_node_path, edges),
+                                  lambda _: n_cars, 'cars/s')
+        record('schedule', lambda: schedule_departures(answer_road_path, carData, roadData),
+               lambda _: n_cars, 'cars/s')
+        record('write', lambda: write_answer(os.path.join(tmp, 'answer.txt'), answer_road_path),
+               lambda _: n_cars, 'cars/s')
+        result = record('simulate', lambda: back_propagation.simulate(answer_road_path, carData, roadData, crossData,
+                                                                      max_ticks=max_ticks),
+                        lambda res: res[3], 'ticks/s')
+    stages['simulate']['ticks'] = result[3]
+    stages['simulate']['deadlock'] = bool(result[2])
+    return dict(config=config, stages=stages)
+
+
+def compare(result, baseline, tolerance=0.2, min_seconds=0.05):
+    """
+    与基线比较每个阶段的耗时
+    :param tolerance: 耗时超过基线的(1 + tolerance)倍时认为变慢
+    :param min_seconds: 耗时低于该值的阶段计时误差太大，不判断是否变慢
+    :return: 变慢的阶段list(阶段, 基线秒数, 本次秒数)
+    """
+    if result['config'] != baseline['config']:
+        print('警告: 测试参数与基线不同', file=sys.stderr)
+    slower = []
+    for name, stage in result['stages'].items():
+        base = baseline['stages'].get(name)
+        if base is None or stage['seconds'] < min_seconds:
+            continue
+        if stage['seconds'] > base['seconds'] * (1 + tolerance):
+            slower.append((name, base['seconds'], stage['seconds']))
+    return slower
+
+
+def print_report(result, baseline=None):
+    "按阶段输出耗时、吞吐量、内存峰值，给出基线时输出相对基线的耗时比例"
+    print('{:<10}{:>10}{:>16}{:>12}{:>10}'.format('stage', 'seconds', 'throughput', 'peak MB', 'vs base'))
+    for name, stage in result['stages'].items():
+        peak = '-' if stage['peak_mb'] is None else '{:.1f}'.format(stage['peak_mb'])
+        ratio = '-'
+        if baseline is not None and name in baseline['stages'] and baseline['stages'][name]['seconds']:
+            ratio = '{:.2f}x'.format(stage['seconds'] / baseline['stages'][name]['seconds'])
+        print('{:<10}{:>10.3f}{:>16}{:>12}{:>10}'.format(name, stage['seconds'],
+                                                      '{:.0f} {}'.format(stage['rate'], stage['unit']), peak, ratio))
+    simulate = result['stages'].get('simulate')
+    if simulate is not None:
+        print('simulate: {} ticks{}'.format(simulate['ticks'], ', deadlock' if simulate['deadlock'] else ''))
+
+
+def _int_list(text):
+    return tuple(int(x) for x in text.split(','))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='规划器和调度器的性能测试')
+    parser.add_argument('--rows', type=int, default=8)
+    parser.add_argument('--cols', type=int, default=8)
+    parser.add_argument('--cars', type=int, default=10240)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--duplex', type=float, default=1.0, help='内部道路为双向的比例')
+    parser.add_argument('--channels', type=_int_list, default=(1, 2, 3, 4, 5), help='车道数，逗号分隔')
+    parser.add_argument('--road-speeds', type=_int_list, default=(4, 6, 8), help='道路限速，逗号分隔')
+    parser.add_argument('--car-speeds', type=_int_list, default=(2, 4, 6, 8), help='车速，逗号分隔')
+    parser.add_argument('--plan-span', type=int, default=10, help='planTime的最大值')
+    parser.add_argument('--batch-size', type=int, default=100, help='路径规划的批大小，0表示静态规划')
+    parser.add_argument('--ticks', type=int, default=200, help='调度的时刻数上限，0表示调度到结束')
+    parser.add_argument('--no-memory', action='store_true', help='不统计内存峰值')
+    parser.add_argument('--data-dir', help='保留生成的数据的目录')
+    parser.add_argument('--baseline', help='比较的基线JSON')
+    parser.add_argument('--save', help='把结果保存为JSON，可以作为以后的基线')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='耗时超过基线的比例')
+    parser.add_argument('--min-seconds', type=float, default=0.05, help='耗时低于该值的阶段不与基线比较')
+    parser.add_argument('--repeat', type=int, default=3, help='每个阶段运行的次数，耗时取最快的一次')
+    args = parser.parse_args(argv)
+
+    result = run_benchmarks(args.rows, args.cols, args.cars, args.seed, args.duplex, args.channels, args.road_speeds,
+                            args.car_speeds, args.plan_span, args.batch_size, args.ticks, not args.no_memory,
+                            args.data_dir, args.repeat)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(result, f, indent=2)
+    if baseline is not None:
+        slower = compare(result, baseline, args.tolerance, args.min_seconds)
+        for name, base_seconds, seconds in slower:
+            print('{} 变慢: {:.3f}s --> {:.3f}s'.format(name, base_seconds, seconds))
+        return 1 if slower else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
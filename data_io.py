@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+
+"""
+@File    :   data_io.py
+@Desc    :   car/road/cross/answer 文件的批量读取，直接解析为numpy数组;
+             以numpy结构化数组保存的CarTable/RoadTable/CrossTable;
+             answer文件的分块写入，以及CSR格式的二进制方案文件
+"""
+
+import os
+from itertools import chain
+
+import numpy as np
+from numpy.lib import recfunctions
+
+BLOCK_SIZE = 1 << 24  # 生成器模式下每次读取的字节数
+WRITE_LINES = 1 << 16  # 写answer文件时每次拼接的行数
+
+ANSWER_HEAD = '#(carId,StartTime,RoadID...)'
+# 二进制方案文件中的数组，每个数组为目录下的一个.npy文件
+PLAN_ARRAYS = ('car_id', 'start_time', 'indptr', 'road_id')
+
+# 除数字、负号和空白之外的字符全部替换成空格，交给np.fromstring一次解析
+_TRANS = bytes.maketrans(b'(),\r\t\n', b'      ')
+_POW10 = 10 ** np.arange(19, dtype=np.int64)
+
+
+def _parse_head(line):
+    "解析首行注释 #(id,from,to,...) 得到列名"
+    line = line.decode('ascii') if isinstance(line, bytes) else line
+    return [name.strip() for name in line.strip().lstrip('#').strip('()').split(',')]
+
+
+def _parse_block(block):
+    """
+    把若干完整的行解析为一维数组和每行的数字个数
+    :param block: 只包含完整行的bytes
+    :return: (values, counts)
+    """
+    buf = np.frombuffer(block, dtype=np.uint8)
+    # uint8相减回绕，小于'0'的字符变为大数，只需一次比较
+    is_num = (buf - np.uint8(ord('0'))) <= 9
+    is_num |= buf == ord('-')
+    # 每个数字第一个字符的位置，按数字个数而不是字节数分配
+    starts = np.flatnonzero(is_num[1:] > is_num[:-1]) + 1
+    first = bool(is_num[:1].any())
+    del is_num
+    ends = np.flatnonzero(buf == ord('\n'))
+    if len(buf) and buf[-1] != ord('\n'):
+        ends = np.append(ends, len(buf))
+    # 第i行的数字个数 = 第i行结束之前的数字起点数 - 第i-1行结束之前的数字起点数
+    counts = np.diff(np.searchsorted(starts, ends), prepend=0)
+    del starts
+    if first:
+        counts[0] += 1
+    counts = counts[counts > 0]  # 去掉空行
+    values = np.fromstring(block.translate(_TRANS), dtype=np.int64, sep=' ')
+    if values.size != counts.sum():
+        raise ValueError('数据格式错误，解析出的数字个数与行数不匹配')
+    return values, counts
+
+
+def _iter_blocks(path, block_size):
+    "按块读取文件，每块都在换行处截断，返回(列名, 块)"
+    with open(path, 'rb') as f:
+        head = _parse_head(f.readline())
+        rest = b''
+        while True:
+            data = f.read(block_size)
+            if not data:
+                break
+            data = rest + data
+            cut = data.rfind(b'\n') + 1
+            if cut == 0:
+                rest = data
+                continue
+            rest = data[cut:]
+            yield head, data[:cut]
+        if rest.strip():
+            yield head, rest
+
+
+def _to_table(values, counts, n_cols):
+    "定长记录的一维数组转为二维数组"
+    if counts.size and (counts != n_cols).any():
+        raise ValueError('数据格式错误，存在列数不等于{}的行'.format(n_cols))
+    return values.reshape(-1, n_cols)
+
+
+def _to_csr(values, counts):
+    "answer的一维数组转为 (car_id, start_time, indptr, road_id)"
+    line_start = np.cumsum(counts) - counts
+    is_road = np.ones(values.size, dtype=bool)
+    is_road[line_start] = False
+    is_road[line_start + 1] = False
+    indptr = np.zeros(counts.size + 1, dtype=np.int64)
+    np.cumsum(counts - 2, out=indptr[1:])
+    return values[line_start], values[line_start + 1], indptr, values[is_road]
+
+
+def read_txt(path):
+    """
+    一次读入整个car/road/cross文件
+    :param path: 文件路径
+    :return: (列名list, 二维int64数组)
+    """
+    with open(path, 'rb') as f:
+        head = _parse_head(f.readline())
+        values, counts = _parse_block(f.read())
+    return head, _to_table(values, counts, len(head))
+
+
+def write_txt(path, head, values):
+    """
+    写入car/road/cross格式的文件，与read_txt对应
+    :param head: 列名list，写为首行注释 #(id,from,to,...)
+    :param values: 二维int数组，每行一条记录
+    """
+    values = np.asarray(values, dtype=np.int64)
+    with open(path, 'w') as f:
+        f.write('#({})\n'.format(','.join(head)))
+        if values.size:
+            f.write(_format_lines(values.ravel(), np.full(len(values), values.shape[1])).decode('ascii'))
+
+
+def iter_txt(path, block_size=BLOCK_SIZE):
+    """
+    生成器模式，按块读取超出内存的文件
+    :return: 每次返回 (列名list, 二维int64数组)
+    """
+    for head, block in _iter_blocks(path, block_size):
+        yield head, _to_table(*_parse_block(block), len(head))
+
+
+def read_answer(path):
+    """
+    一次读入整个answer文件，变长的路线按CSR格式存放
+    第k辆车的路线为 road_id[indptr[k]: indptr[k + 1]]
+    :param path: 文件路径
+    :return: (car_id, start_time, indptr, road_id)
+    """
+    with open(path, 'rb') as f:
+        f.readline()
+        values, counts = _parse_block(f.read())
+    return _to_csr(values, counts)
+
+
+def iter_answer(path, block_size=BLOCK_SIZE):
+    """
+    生成器模式读取answer文件
+    :return: 每次返回一块的 (car_id, start_time, indptr, road_id)
+    """
+    for _, block in _iter_blocks(path, block_size):
+        yield _to_csr(*_parse_block(block))
+
+
+def _digit_table():
+    """
+    0~9999的4位ASCII码表，每项按uint32存放，用于一次查出4位数字
+    前10000项去掉了前导0(数字的最高4位)，后10000项保留前导0(中间的4位)
+    """
+    num = np.arange(10000)
+    place = np.array([1000, 100, 10, 1])
+    digits = (num[:, None] // place % 10 + ord('0')).astype(np.uint8)
+    lead = digits * ((num[:, None] >= place) | (place == 1))
+    return np.concatenate((lead, digits)).view(np.uint32).ravel()
+
+
+_DIGITS = _digit_table()
+
+
+def _format_lines(values, counts):
+    """
+    把若干行整数格式化为 str(tuple(line)) 的形式，每行以换行符结尾
+    每个数字占一行定长的字节: '(' '-' 两个前缀字节，按4位一组右对齐的数字，', '或')\n'两个后缀字节，
+    不需要的字节为0，最后去掉所有的0，得到拼接好的文本
+    :param values: 所有行的数字依次拼接的一维数组
+    :param counts: 每行的数字个数，每行至少2个
+    :return: bytes
+    """
+    line_end = np.cumsum(counts)
+    mag = np.abs(values)
+    n_group = max(1, -(-len(str(int(mag.max(initial=0)))) // 4))
+    # 按uint32写入时每组4个字节对齐，前缀和后缀各占4个字节
+    cells = np.zeros((len(values), n_group + 2), dtype=np.uint32)
+    text = cells.view(np.uint8)
+    text[line_end - counts, 0] = ord('(')
+    text[:, 1] = (values < 0) * ord('-')
+    q = mag
+    for k in range(n_group):
+        q, r = np.divmod(q, 10000)
+        # 高位还有数字时保留前导0，最低一组为0时保留一个'0'
+        r += (q > 0) * 10000
+        group = _DIGITS[r]
+        if k:
+            group[r == 0] = 0
+        cells[:, n_group - k] = group
+    text[:, -4] = ord(',')
+    text[:, -3] = ord(' ')
+    text[line_end - 1, -4] = ord(')')
+    text[line_end - 1, -3] = ord('\n')
+    text = text.ravel()
+    return text[text != 0].tobytes()
+
+
+def write_answer(path, answer_list, chunk=WRITE_LINES):
+    """
+    写入answer文件，内容与逐行写入 str(tuple(line)) 完全相同
+    每chunk行转为一维数组后整块格式化、一次写入
+    :param answer_list: list(id, StartTime, road1, road2 ...)
+    """
+    with open(path, 'w') as f:
+        f.write(ANSWER_HEAD)
+        for i in range(0, len(answer_list), chunk):
+            lines = answer_list[i: i + chunk]
+            counts = np.fromiter(map(len, lines), dtype=np.int64, count=len(lines))
+            values = np.fromiter(chain.from_iterable(lines), dtype=np.int64, count=counts.sum())
+            text = _format_lines(values, counts).decode('ascii')
+            # 换行符写在每行前面，文件不以换行符结尾
+            f.write('\n' + text[:-1])
+
+
+def answer_to_csr(answer_list):
+    """
+    list形式的方案转为CSR格式
+    :param answer_list: list(id, StartTime, road1, road2 ...)
+    :return: (car_id, start_time, indptr, road_id)
+    """
+    counts = np.fromiter((len(line) - 2 for line in answer_list), dtype=np.int64, count=len(answer_list))
+    indptr = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    car_id = np.fromiter((line[0] for line in answer_list), dtype=np.int64, count=len(answer_list))
+    start_time = np.fromiter((line[1] for line in answer_list), dtype=np.int64, count=len(answer_list))
+    road_id = np.fromiter(chain.from_iterable(line[2:] for line in answer_list), dtype=np.int64, count=indptr[-1])
+    return car_id, start_time, indptr, road_id
+
+
+def csr_to_answer(car_id, start_time, indptr, road_id):
+    "CSR格式的方案转为list(id, StartTime, road1, road2 ...)"
+    roads = road_id.tolist()
+    return [[c, s] + roads[lo: hi] for c, s, lo, hi in zip(car_id.tolist(), start_time.tolist(),
+                                                            indptr[:-1].tolist(), indptr[1:].tolist())]
+
+
+def save_plan(path, car_id, start_time, indptr, road_id):
+    """
+    保存CSR格式的二进制方案，每个数组保存为目录path下的一个.npy文件
+    第k辆车的路线为 road_id[indptr[k]: indptr[k + 1]]
+    """
+    os.makedirs(path, exist_ok=True)
+    for name, value in zip(PLAN_ARRAYS, (car_id, start_time, indptr, road_id)):
+        np.save(os.path.join(path, name + '.npy'), np.asarray(value, dtype=np.int64))
+
+
+def load_plan(path, mmap_mode='r'):
+    """
+    读取save_plan保存的方案
+    :param mmap_mode: 默认'r'为只读的内存映射，None表示读入内存
+    :return: (car_id, start_time, indptr, road_id)
+    """
+    return tuple(np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode) for name in PLAN_ARRAYS)
+
+
+def read_plan(path):
+    """
+    读取方案，path为目录时按二进制方案读取，否则按answer文件读取
+    :return: (car_id, start_time, indptr, road_id)
+    """
+    if os.path.isdir(path):
+        return load_plan(path)
+    return read_answer(path)
+
+
+class _Table:
+    """
+    列式存储的数据表，底层是numpy结构化数组
+    按列访问: table.speed 或 table['from'];
+    按id查行: table.row(id) / table.rows(ids)，都是O(1)的数组查找
+    """
+    dtype = None
+
+    def __init__(self, data):
+        self.data = data
+        self._build_index()
+
+    @classmethod
+    def from_array(cls, values):
+        "由read_txt得到的二维数组生成数据表"
+        return cls(recfunctions.unstructured_to_structured(np.ascontiguousarray(values), dtype=cls.dtype))
+
+    def _build_index(self):
+        # id一般是连续的，用偏移后的稠密数组做id-->行号的映射;
+        # id很稀疏时稠密数组太大，改为在排好序的id上二分查找
+        ids = self.data['id']
+        self._offset = int(ids.min()) if len(ids) else 0
+        span = int(ids.max()) - self._offset + 1 if len(ids) else 0
+        if span <= 4 * len(ids) + 1024:
+            self._index = np.full(span, -1, dtype=np.int64)
+            self._index[ids - self._offset] = np.arange(len(ids))
+            self._sorted = None
+        else:
+            order = np.argsort(ids, kind='stable')
+            self._index = None
+            self._sorted = (ids[order], order)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, name):
+        return self.data[name]
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name == 'data':
+            raise AttributeError(name)
+        try:
+            return self.data[name]
+        except ValueError:
+            raise AttributeError(name)
+
+    @property
+    def values(self):
+        "二维int数组形式的数据，列顺序与文件一致"
+        return recfunctions.structured_to_unstructured(self.data)
+
+    def row(self, id):
+        "根据id查找行号，id不存在时抛出KeyError"
+        if self._index is None:
+            return int(self.rows(id))
+        pos = id - self._offset
+        row = int(self._index[pos]) if 0 <= pos < len(self._index) else -1
+        if row < 0:
+            raise KeyError(id)
+        return row
+
+    def rows(self, ids):
+        "根据id数组批量查找行号，有不存在的id时抛出KeyError"
+        ids = np.asarray(ids, dtype=np.int64)
+        if self._index is None:
+            sorted_ids, order = self._sorted
+            pos = np.minimum(np.searchsorted(sorted_ids, ids), len(sorted_ids) - 1)
+            missing = sorted_ids[pos] != ids
+            rows = order[pos]
+        else:
+            pos = ids - self._offset
+            valid = (pos >= 0) & (pos < len(self._index))
+            rows = self._index[np.where(valid, pos, 0)] if len(self._index) else np.full(pos.shape, -1)
+            missing = ~valid | (rows < 0)
+        if missing.any():
+            raise KeyError(ids[missing].ravel()[0].item())
+        return rows
+
+    def take(self, rows):
+        "按行号(或排序结果)取出子表"
+        return type(self)(self.data[rows])
+
+
+class CarTable(_Table):
+    dtype = np.dtype([('id', np.int64), ('from', np.int64), ('to', np.int64),
+                      ('speed', np.int64), ('planTime', np.int64)])
+
+
+class RoadTable(_Table):
+    dtype = np.dtype([('id', np.int64), ('length', np.int64), ('speed', np.int64), ('channel', np.int64),
+                      ('from', np.int64), ('to', np.int64), ('isDuplex', np.int64)])
+
+
+class CrossTable(_Table):
+    # roadId按上、右、下、左的顺时针顺序存放，-1表示该方向没有道路
+    dtype = np.dtype([('id', np.int64), ('roadId', np.int64, (4,))])
+
+
+def read_data(car_path, road_path, cross_path):
+    """
+    从给定的路径读取数据
+    :return: (carData, roadData, crossData)
+    """
+    carData = CarTable.from_array(read_txt(car_path)[1])
+    roadData = RoadTable.from_array(read_txt(road_path)[1])
+    crossData = CrossTable.from_array(read_txt(cross_path)[1])
+    return carData, roadData, crossData
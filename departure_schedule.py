@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+"""
+@File    :   departure_schedule.py
+@Desc    :   根据道路容量安排车辆的出发时间;
+             按时间分桶统计每条道路每个方向上的占用(车辆*时刻)，在不超过容量的前提下尽早出发
+"""
+
+from itertools import chain
+
+import numpy as np
+
+from road_graph import route_entries
+
+
+def route_stays(answer_road_path, carData, roadData):
+    """
+    计算每辆车按路线行驶时在每条路上的停留时间，不考虑拥堵
+    :param answer_road_path: list(id, StartTime, road1, road2 ...)
+    :return: (car_rows, indptr, road_dir, offset, duration)
+    第k辆车的路线为 [indptr[k]: indptr[k + 1]]，road_dir = 道路行号 * 2 + 方向，
+    offset为驶入该道路的时间相对于出发时间的偏移，duration为在该道路上的停留时间
+    """
+    car_ids = np.array([temp[0] for temp in answer_road_path], dtype=np.int64)
+    counts = np.array([len(temp) - 2 for temp in answer_road_path], dtype=np.int64)
+    roads = np.fromiter(chain.from_iterable(temp[2:] for temp in answer_road_path), dtype=np.int64,
+                        count=counts.sum())
+    indptr = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    first = indptr[:-1]
+
+    car_rows = carData.rows(car_ids)
+    road_rows, road_from, _, entry = route_entries(car_ids, carData['from'][car_rows], counts, roads, roadData)
+    road_dir = road_rows * 2 + (road_from != entry)
+
+    speed = np.minimum(roadData.speed[road_rows], np.repeat(carData.speed[car_rows], counts))
+    duration = -(-roadData.length[road_rows] // speed)
+    # 车内的累加和减去本段的停留时间，得到驶入每条路的偏移
+    total = np.cumsum(duration)
+    offset = total - duration - np.repeat(total[first] - duration[first], counts)
+    return car_rows, indptr, road_dir, offset, duration
+
+
+def _bucket_demand(start, cars, indptr, road_dir, offset, duration, bucket, n_buckets):
+    """
+    按给定的出发时间计算一组车辆在各个(道路方向, 时间桶)上的占用
+    :return: (owner, cell, demand) owner为车辆在cars中的下标，cell = road_dir * n_buckets + 桶号
+    """
+    counts = indptr[cars + 1] - indptr[cars]
+    seg = np.repeat(np.arange(len(cars)), counts)
+    pos = np.repeat(indptr[cars] - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+    enter = start[cars[seg]] + offset[pos]
+    leave = enter + duration[pos]
+    # 一次停留可能跨越多个时间桶，按桶展开后计算每个桶内的重叠时间
+    first_bucket = enter // bucket
+    spans = (leave - 1) // bucket - first_bucket + 1
+    rows = np.repeat(np.arange(len(pos)), spans)
+    k = np.repeat(first_bucket, spans) + np.arange(len(rows)) - np.repeat(np.cumsum(spans) - spans, spans)
+    demand = np.minimum(leave[rows], (k + 1) * bucket) - np.maximum(enter[rows], k * bucket)
+    return seg[rows], road_dir[pos][rows] * n_buckets + k, demand
+
+
+def schedule_departures(answer_road_path, carData, roadData, bucket=10, load_factor=0.5, window=256):
+    """
+    在道路容量允许时尽早安排出发，出发时间不早于planTime
+    按时间桶依次处理，每个桶从已到planTime、还没出发的车辆中按(planTime, 原顺序)取出一批候选，
+    用格子内的累加和一次判断: 每个占用格子上排在本车之前的候选车辆需求加上已有占用都不超过容量的车辆在本桶出发，
+    其余车辆留到下一个桶
+    :param answer_road_path: list(id, StartTime, road1, road2 ...)，直接修改其中的StartTime
+    :param bucket: 时间桶的宽度(时刻数)
+    :param load_factor: 每条道路允许的平均占用率，容量为 车道数 * 长度 * load_factor，至少为1辆车
+    :param window: 候选车辆数比上一个桶出发的车辆数多出的数量
+    :return: answer_road_path
+    """
+    if not answer_road_path:
+        return answer_road_path
+    car_rows, indptr, road_dir, offset, duration = route_stays(answer_road_path, carData, roadData)
+    plan_time = carData.planTime[car_rows]
+    order = np.lexsort((np.arange(len(car_rows)), plan_time))
+    release = plan_time[order]
+    # 每个时间桶内每个道路方向可以容纳的车辆*时刻数，
+    # 至少能容纳一辆车停留整个时间桶，否则单独一辆车也超出容量，永远不能出发
+    capacity = np.repeat(np.maximum(roadData.channel * roadData.length * load_factor, 1) * bucket, 2)
+
+    n_buckets = int(release[-1] // bucket) + 2
+    # 每个(道路方向, 时间桶)格子剩余的容量
+    room = np.repeat(capacity, n_buckets)
+    start = np.zeros(len(car_rows), dtype=np.int64)
+    # pending[head:]为已到planTime、还没出发的车辆，按优先级排列
+    pending = np.zeros(0, dtype=np.int64)
+    head = 0
+    released = 0
+    width = window
+    b = int(release[0] // bucket)
+    while released < len(order) or head < len(pending):
+        hi = np.searchsorted(release, (b + 1) * bucket, side='left')
+        if hi > released:
+            pending = np.concatenate((pending[head:], order[released:hi]))
+            head = 0
+            released = hi
+        if head == len(pending):
+            # 没有可以出发的车辆，直接跳到下一辆车的planTime
+            b = int(release[released] // bucket)
+            continue
+        cars = pending[head: head + width].copy()
+        start[cars] = np.maximum(plan_time[cars], b * bucket)
+        # 占用超出现有的时间范围时，把剩余容量数组扩大一倍
+        last = indptr[cars + 1] - 1
+        horizon = int((start[cars] + offset[last] + duration[last]).max()) // bucket
+        if horizon >= n_buckets:
+            grow = max(n_buckets, horizon + 1 - n_buckets)
+            room = np.hstack((room.reshape(len(capacity), n_buckets),
+                              np.repeat(capacity[:, None], grow, axis=1))).ravel()
+            n_buckets += grow
+        owner, cell, demand = _bucket_demand(start, cars, indptr, road_dir, offset, duration, bucket, n_buckets)
+
+        # 同一个格子上按候选顺序累加需求，owner本身是有序的，按 格子 * 元素数 + 下标 排序后格子内仍按候选顺序排列;
+        # 键各不相同，直接对键排序比稳定的argsort快得多，下标和格子都能从键中取回
+        key = np.sort(cell * len(cell) + np.arange(len(cell)))
+        cell_sorted, idx = np.divmod(key, len(cell))
+        demand_sorted = demand[idx]
+        is_start = np.empty(len(idx), dtype=bool)
+        is_start[0] = True
+        np.not_equal(cell_sorted[1:], cell_sorted[:-1], out=is_start[1:])
+        seg_start = np.flatnonzero(is_start)
+        total = np.cumsum(demand_sorted)
+        seg_base = np.repeat(total[seg_start] - demand_sorted[seg_start], np.diff(seg_start, append=len(idx)))
+        owner_sorted = owner[idx]
+        ok = np.bincount(owner_sorted[total - seg_base > room[cell_sorted]], minlength=len(cars)) == 0
+
+        # 出发车辆的需求按格子合并后从剩余容量中扣除
+        admit = ok[owner_sorted]
+        cell_sorted, demand_sorted, is_start = cell_sorted[admit], demand_sorted[admit], is_start[admit]
+        if len(cell_sorted):
+            is_start[0] = True
+            np.not_equal(cell_sorted[1:], cell_sorted[:-1], out=is_start[1:])
+            seg_start = np.flatnonzero(is_start)
+            room[cell_sorted[seg_start]] -= np.add.reduceat(demand_sorted, seg_start)
+        # 没有出发的车辆按原顺序留在队列前面，下一个桶再判断
+        admitted = int(ok.sum())
+        pending[head + admitted: head + len(cars)] = cars[~ok]
+        head += admitted
+        width = admitted + window
+        b += 1
+
+    for k, temp in enumerate(answer_road_path):
+        temp[1] = int(start[k])
+    return answer_road_path
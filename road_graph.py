@@ -0,0 +1,827 @@
+# -*- coding: utf-8 -*-
+
+"""
+@File    :   road_graph.py
+@Desc    :   由道路数据生成交叉口之间的有向图，CSR稀疏存储;
+             最短路径树、路由表、路线缓存以及多进程的路线规划;
+             单次查询的双向dijkstra和A*搜索
+"""
+
+import copy
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from heapq import *
+
+import numpy as np
+
+from shared_array import share_array, attach_array
+
+M = 99999  # This represents that there is no link.
+
+
+class CSRGraph:
+    """
+    交叉口之间的有向图，按CSR格式存储
+    节点u的出边为 indices[indptr[u]: indptr[u + 1]]，
+    对应的权值、道路id和容量(车道数*长度)分别在weights、roads和capacity的相同位置
+    epoch为边权的版本号，每次set_weights加1
+    coords为由路口拓扑推断的网格坐标(x, y)，不是网格时为None，第一次使用时才推断，不用A*时没有开销
+    """
+
+    def __init__(self, n, indptr, indices, weights, roads, capacity=None):
+        self.n = n
+        self.indptr = indptr
+        self.indices = indices
+        self.weights = weights
+        self.roads = roads
+        self.capacity = capacity
+        # 出边按(起点, 终点)排好序，keys用于(u, v)-->边号的二分查找
+        self._keys = np.repeat(np.arange(n, dtype=np.int64), np.diff(indptr)) * n + indices
+        self._adjacency = None
+        self._search_engine = None
+        self._route_cache = None
+        self.epoch = 0
+        # {'value': 坐标} 或 {'source': (roadData, crossData)}，浅拷贝的图共享同一个dict，坐标只推断一次
+        self._coords = {'value': None}
+
+    def __len__(self):
+        return len(self.indices)
+
+    @property
+    def coords(self):
+        lazy = self._coords
+        if 'source' in lazy:
+            lazy['value'] = infer_cross_coordinates(*lazy.pop('source'))
+        return lazy['value']
+
+    @coords.setter
+    def coords(self, value):
+        self._coords = {'value': value}
+
+    def adjacency(self):
+        """
+        python list形式的邻接表，供逐点扩展的dijkstra使用
+        :return: list(node -> list((cost, node)))
+        """
+        if self._adjacency is None:
+            indptr, indices, weights = self.indptr.tolist(), self.indices.tolist(), self.weights.tolist()
+            self._adjacency = [list(zip(weights[indptr[u]: indptr[u + 1]], indices[indptr[u]: indptr[u + 1]]))
+                               for u in range(self.n)]
+        return self._adjacency
+
+    def search_engine(self):
+        "该图上的单次查询搜索引擎，搜索用的数组在多次查询之间复用"
+        if self._search_engine is None:
+            self._search_engine = SearchEngine(self)
+        return self._search_engine
+
+    def route_cache(self):
+        "该图上dijkstra的路线缓存，键中的epoch区分边权版本"
+        if self._route_cache is None:
+            self._route_cache = RouteCache()
+        return self._route_cache
+
+    def with_weights(self, weights):
+        "边权不同、其余数组和坐标都共享的新图"
+        graph = copy.copy(self)
+        graph.weights = weights
+        graph._adjacency = None
+        graph._search_engine = None
+        graph._route_cache = None
+        graph.epoch = 0
+        return graph
+
+    def set_weights(self, weights):
+        "替换边权，邻接表重新生成，版本号加1使缓存的路线失效"
+        self.weights = weights
+        self._adjacency = None
+        self.epoch += 1
+
+    def edge_index(self, start, end):
+        "批量查找(start, end)对应的边号，不存在时为-1，start和end都是标量时返回标量"
+        query = np.asarray(start, dtype=np.int64) * self.n + np.asarray(end, dtype=np.int64)
+        flat = query.reshape(-1)
+        if len(self._keys):
+            pos = np.searchsorted(self._keys, flat)
+            pos[pos == len(self._keys)] = 0
+            index = np.where(self._keys[pos] == flat, pos, -1)
+        else:
+            index = np.full(flat.shape, -1)
+        return index.reshape(query.shape)[()]
+
+    def road_ids(self, nodes):
+        """
+        把经过的交叉口序列转换为道路id序列
+        :param nodes: 交叉口序列
+        :return: 道路id数组，两个交叉口之间没有道路时为-1
+        """
+        nodes = np.asarray(nodes, dtype=np.int64)
+        index = self.edge_index(nodes[:-1], nodes[1:])
+        return np.where(index >= 0, self.roads[index], -1)
+
+    def to_dense(self):
+        """
+        生成稠密矩阵，只适合交叉口数量较少的地图
+        :return: (cross_graph, adjacent_matrix)
+        """
+        src = self._keys // self.n
+        cross_graph = np.full((self.n, self.n), -1, dtype=np.int64)
+        adjacent_matrix = np.full((self.n, self.n), M)
+        cross_graph[src, self.indices] = self.roads
+        adjacent_matrix[src, self.indices] = self.weights
+        return cross_graph, adjacent_matrix
+
+
+class RouteCache:
+    """
+    有界的LRU路线缓存，键为(出发节点, 目的节点, 边权版本)
+    边权变化后版本号不同，旧的路线不会再命中，随LRU淘汰
+    """
+
+    def __init__(self, maxsize=65536):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, start, end, epoch):
+        "命中时返回缓存的值并移到最近使用的位置，否则返回None"
+        key = (start, end, epoch)
+        value = self._data.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, start, end, epoch, value):
+        self._data[(start, end, epoch)] = value
+        self._data.move_to_end((start, end, epoch))
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+
+def create_road_between_cross_graph(roadData, crossData, dense=True):
+    """
+    生成道路查找矩阵cross_graph;
+    生成cross间权值矩阵weight_matrix;
+    生成边 edges，CSR格式;
+    :param roadData:
+    :param crossData:
+    :param dense: 为False时不生成N*N的稠密矩阵，cross_graph和adjacent_matrix返回None
+    :return: (cross_graph, adjacent_matrix, edges)
+    """
+    n = len(crossData)
+    u = roadData['from'] - 1
+    v = roadData.to - 1
+    duplex = roadData.isDuplex == 1
+    # 双向道路拆成两条有向边
+    src = np.concatenate((u, v[duplex]))
+    dst = np.concatenate((v, u[duplex]))
+    weight = np.concatenate((roadData.length, roadData.length[duplex]))
+    road = np.concatenate((roadData.id, roadData.id[duplex]))
+    capacity = roadData.channel * roadData.length
+    capacity = np.concatenate((capacity, capacity[duplex]))
+
+    keep = src != dst
+    order = np.lexsort((weight[keep], dst[keep], src[keep]))
+    src, dst, weight, road, capacity = (arr[keep][order] for arr in (src, dst, weight, road, capacity))
+    # 两个交叉口之间有多条道路时只保留最短的一条
+    first = np.ones(len(src), dtype=bool)
+    first[1:] = (src[1:] != src[:-1]) | (dst[1:] != dst[:-1])
+    src, dst, weight, road, capacity = (arr[first] for arr in (src, dst, weight, road, capacity))
+
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=n), out=indptr[1:])
+    edges = CSRGraph(n, indptr, dst, weight, road, capacity)
+    edges._coords = {'source': (roadData, crossData)}
+    if not dense:
+        return None, None, edges
+    cross_graph, adjacent_matrix = edges.to_dense()
+    return cross_graph, adjacent_matrix, edges
+
+
+# cross.txt中道路按上、右、下、左的顺时针顺序排列，对应的坐标变化
+_DIRECTIONS = ((0, 1), (1, 0), (0, -1), (-1, 0))
+
+
+def infer_cross_coordinates(roadData, crossData):
+    """
+    由每个路口道路的顺时针顺序推断路口的网格坐标
+    从每个连通分量的第一个路口开始广度优先遍历，沿道路方向坐标相差1;
+    路口的道路列表可能整体旋转，旋转量由到达它的道路在列表中的位置确定
+    :return: (x, y) 以 路口id-1 为下标的坐标数组，坐标出现矛盾(不是网格)、
+             路口的道路不在road.txt中或道路两端的路口不一致时返回None
+    """
+    n = len(crossData)
+    road_ends = dict(zip(roadData.id.tolist(), zip(roadData['from'].tolist(), roadData.to.tolist())))
+    try:
+        cross_roads = (crossData.roadId[crossData.rows(np.arange(1, n + 1))]).tolist()
+    except KeyError:
+        return None
+    x, y, rot = [0] * n, [0] * n, [-1] * n
+    offset = 0  # 不同的连通分量放在不同的位置
+    for root in range(n):
+        if rot[root] >= 0:
+            continue
+        x[root], y[root], rot[root] = offset, 0, 0
+        queue = [root]
+        for u in queue:
+            for i, road in enumerate(cross_roads[u]):
+                if road == -1:
+                    continue
+                if road not in road_ends or u + 1 not in road_ends[road]:
+                    return None
+                road_from, road_to = road_ends[road]
+                v = (road_to if road_from == u + 1 else road_from) - 1
+                if v == u:
+                    continue
+                if not 0 <= v < n or road not in cross_roads[v]:
+                    return None
+                d = (i + rot[u]) % 4
+                vx, vy = x[u] + _DIRECTIONS[d][0], y[u] + _DIRECTIONS[d][1]
+                # 从v看这条路的方向与d相反
+                v_rot = (d + 2 - cross_roads[v].index(road)) % 4
+                if rot[v] < 0:
+                    x[v], y[v], rot[v] = vx, vy, v_rot
+                    queue.append(v)
+                elif (x[v], y[v], rot[v]) != (vx, vy, v_rot):
+                    return None
+        offset = max(x) + 2
+    return np.array(x, dtype=np.int64), np.array(y, dtype=np.int64)
+
+
+def route_entries(car_ids, car_from, counts, roads, roadData):
+    """
+    计算路线上驶入每条路的路口，并检查路线是否连续
+    第一条路从出发路口驶入，之后从与上一条路的公共路口驶入;
+    两条路连接同一对路口时公共路口不唯一，改用上一条路驶出的路口
+    :param car_ids: 每辆车的id，用于报错
+    :param car_from: 每辆车的出发路口id
+    :param counts: 每辆车路线上的道路数
+    :param roads: 所有车辆的路线依次拼接的道路id
+    :return: (road_rows, road_from, road_to, entry) 每条路在roadData中的行号、两端路口和驶入路口
+    """
+    first = np.cumsum(counts) - counts
+    is_first = np.zeros(len(roads), dtype=bool)
+    is_first[first[counts > 0]] = True
+    road_rows = roadData.rows(roads)
+    road_from, road_to = roadData['from'][road_rows], roadData.to[road_rows]
+    prev_from, prev_to = np.roll(road_from, 1), np.roll(road_to, 1)
+    from_shared = (road_from == prev_from) | (road_from == prev_to)
+    to_shared = (road_to == prev_from) | (road_to == prev_to)
+    entry = np.where(is_first, np.repeat(car_from, counts), np.where(from_shared, road_from, road_to))
+    for k in np.flatnonzero(from_shared & to_shared & ~is_first).tolist():
+        entry[k] = road_from[k - 1] + road_to[k - 1] - entry[k - 1]
+    # 驶入路口必须是道路的一端，且等于上一条路驶出的路口
+    leave = road_from + road_to - entry
+    valid = np.where(is_first, (road_from == entry) | (road_to == entry), entry == np.roll(leave, 1))
+    if not valid.all():
+        bad_car = car_ids[np.searchsorted(first, np.argmin(valid), side='right') - 1]
+        raise Exception('车辆{}的路线不连续'.format(bad_car))
+    return road_rows, road_from, road_to, entry
+
+
+class SearchEngine:
+    """
+    单次查询的最短路径搜索，提供A*和双向dijkstra
+    距离和前驱保存在长度为n的数组中，用查询编号标记本次查询写过的位置，不需要每次清空;
+    settled为上一次查询确定最短距离的节点数
+    """
+
+    def __init__(self, edges):
+        self.edges = edges
+        n = edges.n
+        self._dist = ([0.0] * n, [0.0] * n)
+        self._pred = ([-1] * n, [-1] * n)
+        self._seen = ([0] * n, [0] * n)  # 等于查询编号时dist和pred有效
+        self._done = ([0] * n, [0] * n)  # 等于查询编号时已确定最短距离
+        self._query = 0
+        self._epoch = None
+        self.settled = 0
+
+    def _prepare(self):
+        "边权变化后重新生成正向和反向邻接表，返回本次查询的编号"
+        if self._epoch != self.edges.epoch:
+            forward = self.edges.adjacency()
+            backward = [[] for _ in range(self.edges.n)]
+            for u, out in enumerate(forward):
+                for c, v in out:
+                    backward[v].append((c, u))
+            self._adj = (forward, backward)
+            self._min_weight = float(self.edges.weights.min()) if len(self.edges) else 0.0
+            if self.edges.coords is not None:
+                self._xs, self._ys = self.edges.coords[0].tolist(), self.edges.coords[1].tolist()
+            else:
+                self._xs = self._ys = [0] * self.edges.n
+            self._epoch = self.edges.epoch
+        self._query += 1
+        return self._query
+
+    def _path(self, side, node):
+        "沿前驱数组回溯到搜索起点，返回从起点到node的节点list"
+        pred = self._pred[side]
+        path = [node]
+        while pred[path[-1]] != -1:
+            path.append(pred[path[-1]])
+        path.reverse()
+        return path
+
+    def astar(self, start, end):
+        """
+        A*搜索，启发函数为到终点的网格曼哈顿距离 * 最小边权，没有坐标时退化为dijkstra
+        每条道路使坐标变化1，启发函数是一致的，第一次取出终点时即为最短路径
+        :return: (最短距离, 经过的节点list)，不可达时返回(inf, [])
+        """
+        q = self._prepare()
+        forward = self._adj[0]
+        dist, pred, seen, done = self._dist[0], self._pred[0], self._seen[0], self._done[0]
+        # 没有坐标时所有节点的坐标都为0，启发函数恒为0
+        xs, ys, w = self._xs, self._ys, self._min_weight
+        tx, ty = xs[end], ys[end]
+        dist[start], pred[start], seen[start] = 0, -1, q
+        heap = [((abs(xs[start] - tx) + abs(ys[start] - ty)) * w, 0, start)]
+        settled = 0
+        while heap:
+            _, g, v = heappop(heap)
+            if done[v] == q:
+                continue
+            done[v] = q
+            settled += 1
+            if v == end:
+                self.settled = settled
+                return g, self._path(0, end)
+            for c, u in forward[v]:
+                if done[u] != q and (seen[u] != q or g + c < dist[u]):
+                    dist[u], pred[u], seen[u] = g + c, v, q
+                    heappush(heap, (g + c + (abs(xs[u] - tx) + abs(ys[u] - ty)) * w, g + c, u))
+        self.settled = settled
+        return float('inf'), []
+
+    def bidirectional(self, start, end):
+        """
+        双向dijkstra，从起点正向、从终点沿反向边同时搜索，
+        两边堆顶距离之和不小于已找到的最短路径时结束
+        :return: (最短距离, 经过的节点list)，不可达时返回(inf, [])
+        """
+        q = self._prepare()
+        if start == end:
+            self.settled = 0
+            return 0, [start]
+        dist, pred, seen, done = self._dist, self._pred, self._seen, self._done
+        heaps = ([(0, start)], [(0, end)])
+        for side, source in ((0, start), (1, end)):
+            dist[side][source], pred[side][source], seen[side][source] = 0, -1, q
+        best, meet = float('inf'), -1
+        settled = 0
+        while heaps[0] and heaps[1] and heaps[0][0][0] + heaps[1][0][0] < best:
+            side = 0 if heaps[0][0][0] <= heaps[1][0][0] else 1
+            g, v = heappop(heaps[side])
+            if done[side][v] == q:
+                continue
+            done[side][v] = q
+            settled += 1
+            s_dist, s_pred, s_seen = dist[side], pred[side], seen[side]
+            o_dist, o_seen = dist[1 - side], seen[1 - side]
+            for c, u in self._adj[side][v]:
+                if s_seen[u] != q or g + c < s_dist[u]:
+                    s_dist[u], s_pred[u], s_seen[u] = g + c, v, q
+                    heappush(heaps[side], (g + c, u))
+                    if o_seen[u] == q and g + c + o_dist[u] < best:
+                        best, meet = g + c + o_dist[u], u
+        self.settled = settled
+        if meet < 0:
+            return float('inf'), []
+        # 正向部分回溯到起点，反向部分的前驱指向终点方向
+        return best, self._path(0, meet) + self._path(1, meet)[::-1][1:]
+
+
+def dijkstra(graph, start, end, use_cache=True):
+    """
+    计算两点之间的最短路径，使用图上的A*搜索，启发函数为路口网格坐标的曼哈顿距离
+    :param graph: CSRGraph
+    :param start:
+    :param end:
+    :param use_cache: 是否使用graph.route_cache()，相同(出发点, 终点)在边权不变时只计算一次
+    :return: (最短距离, 经过的节点list)，不可达时返回(-1, [])
+    """
+    cache = graph.route_cache() if use_cache else None
+    if cache is not None:
+        cached = cache.get(start, end, graph.epoch)
+        if cached is not None:
+            return cached[0], list(cached[1])
+    length, path = graph.search_engine().astar(start, end)
+    if not path:
+        length = -1
+    if cache is not None:
+        cache.put(start, end, graph.epoch, (length, tuple(path)))
+    return length, path
+
+
+def shortest_path_tree(graph, source):
+    """
+    单源dijkstra，计算source到所有节点的最短距离和前驱节点
+    :param graph: 邻接表 list(node -> list((cost, node)))
+    :param source: 出发节点
+    :return: (dist, pred) 最短距离和前驱节点的dict
+    """
+    dist = {source: 0}
+    pred = {source: -1}
+    q, seen = [(0, source)], set()
+    while q:
+        cost, v1 = heappop(q)
+        if v1 in seen:
+            continue
+        seen.add(v1)
+        for c, v2 in graph[v1]:
+            if v2 not in seen and cost + c < dist.get(v2, float("inf")):
+                dist[v2] = cost + c
+                pred[v2] = v1
+                heappush(q, (cost + c, v2))
+    return dist, pred
+
+
+def build_route_table(edges, origins):
+    """
+    对每个出发节点只跑一次单源dijkstra，生成全局的路由表
+    :param edges: CSRGraph
+    :param origins: 需要计算的出发节点
+    :return: 路由表 dict(origin -> pred)
+    """
+    graph = edges.adjacency()
+    route_table = dict()
+    for origin in origins:
+        route_table[origin] = shortest_path_tree(graph, origin)[1]
+    return route_table
+
+
+def get_route(route_table, start, end):
+    """
+    根据路由表中的前驱节点回溯出start到end的路径
+    :return: 经过的节点list，不可达时返回[]
+    """
+    pred = route_table[start]
+    if end not in pred:
+        return []
+    path = [end]
+    while path[-1] != start:
+        path.append(pred[path[-1]])
+    path.reverse()
+    return path
+
+
+_worker_graph = None
+_worker_shms = []
+
+
+def _init_worker(n, specs):
+    "子进程初始化，挂载共享的图数据"
+    global _worker_graph
+    arrays = []
+    for spec in specs:
+        shm, arr = attach_array(spec)
+        _worker_shms.append(shm)
+        arrays.append(arr)
+    _worker_graph = CSRGraph(n, *arrays)
+
+
+def _plan_shard(starts, ends):
+    """
+    子进程中规划一组车的路线，这组车的出发节点互不跨组
+    :return: CSR格式的路线 (indptr, nodes)
+    """
+    graph = _worker_graph.adjacency()
+    route_table = dict()
+    for origin in set(starts):
+        route_table[origin] = shortest_path_tree(graph, origin)[1]
+    paths = [get_route(route_table, start, end) for start, end in zip(starts, ends)]
+    indptr = np.zeros(len(paths) + 1, dtype=np.int64)
+    np.cumsum([len(path) for path in paths], out=indptr[1:])
+    nodes = np.fromiter((node for path in paths for node in path), dtype=np.int64, count=indptr[-1])
+    return indptr, nodes
+
+
+def plan_routes(edges, starts, ends, workers=1):
+    """
+    批量规划路线，每个出发节点只计算一次最短路径树
+    workers>1时按出发节点把车辆分组，交给多个进程并行计算，
+    图数据放在共享内存中，不随每个任务序列化
+    :param edges: CSRGraph
+    :param starts: 出发节点数组
+    :param ends: 目的节点数组
+    :param workers: 进程数
+    :return: 与starts顺序一致的路线list
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    if workers <= 1:
+        route_table = build_route_table(edges, set(starts.tolist()))
+        return [get_route(route_table, start, end) for start, end in zip(starts.tolist(), ends.tolist())]
+
+    # 按出发节点分组，每组的车辆数尽量接近
+    order = np.argsort(starts, kind='stable')
+    origins, first = np.unique(starts[order], return_index=True)
+    n_shards = min(len(origins), workers * 4)
+    bounds = first[np.searchsorted(np.cumsum(np.diff(np.append(first, len(starts)))),
+                                   np.linspace(0, len(starts), n_shards + 1)[1:-1], side='right')]
+    shards = np.split(order, np.unique(bounds))
+
+    shms, specs = [], []
+    try:
+        for arr in (edges.indptr, edges.indices, edges.weights, edges.roads):
+            shm, spec = share_array(arr)
+            shms.append(shm)
+            specs.append(spec)
+        paths = [None] * len(starts)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(edges.n, specs)) as executor:
+            futures = [executor.submit(_plan_shard, starts[shard].tolist(), ends[shard].tolist())
+                       for shard in shards if len(shard)]
+            # 各组的结果按原来的位置写回，保持输入的车辆顺序
+            for shard, future in zip([shard for shard in shards if len(shard)], futures):
+                indptr, nodes = future.result()
+                nodes = nodes.tolist()
+                for k, pos in enumerate(shard.tolist()):
+                    paths[pos] = nodes[indptr[k]: indptr[k + 1]]
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+    return paths
+
+
+def speed_class_graphs(edges, roadData, speeds):
+    """
+    每个速度等级生成一个以行驶时间为边权的图，行驶时间 = 长度 / min(道路限速, 车速)
+    除边权外的数组和网格坐标都与edges共享，A*的启发函数按每个图自己的最小边权计算，仍然是一致的
+    :param speeds: 车速数组，每个不同的车速生成一个图
+    :return: dict(speed -> CSRGraph)
+    """
+    road_rows = roadData.rows(edges.roads)
+    length, road_speed = roadData.length[road_rows], roadData.speed[road_rows]
+    return {speed: edges.with_weights(length / np.minimum(road_speed, speed)) for speed in np.unique(speeds).tolist()}
+
+
+def plan_routes_by_speed(edges, roadData, starts, ends, speeds, workers=1):
+    """
+    按行驶时间规划路线，同一速度等级的车辆共享最短路径树，
+    计算量为 速度等级数 * 出发节点数 次单源dijkstra
+    :param speeds: 每辆车的速度
+    :return: 与starts顺序一致的路线list
+    """
+    starts, ends, speeds = (np.asarray(arr, dtype=np.int64) for arr in (starts, ends, speeds))
+    paths = [None] * len(starts)
+    for speed, graph in speed_class_graphs(edges, roadData, speeds).items():
+        pos = np.flatnonzero(speeds == speed)
+        for k, path in zip(pos.tolist(), plan_routes(graph, starts[pos], ends[pos], workers=workers)):
+            paths[k] = path
+    return paths
+
+
+def update_adjacent_matrix(edges, load, alpha=1.0):
+    """
+    根据现在的状态更新权值矩阵
+    权值 = 长度 * (1 + alpha * 占用率)，占用率为道路上的车辆数 / (车道数 * 长度)
+    :param edges: CSRGraph
+    :param load: 每条边上已分配的车辆数
+    :param alpha: 拥堵的惩罚系数
+    :return: 新的边权数组
+    """
+    return edges.weights * (1.0 + alpha * np.asarray(load, dtype=np.float64) / edges.capacity)
+
+
+class DynamicRouter:
+    """
+    拥堵感知的路由
+    出发节点多次查询时维护一棵最短路径树(dist, pred, pred_edge)，只查询一次时用A*单独搜索;
+    边权变化时不立即处理，记录变化的边和原来的边权，下次查询该出发节点时再修复;
+    累计变化的边超过rebuild_ratio时修复比重算更慢，直接丢弃最短路径树
+    """
+
+    def __init__(self, edges, alpha=1.0, decay=0.5, threshold=0.1, cache_size=65536, rebuild_ratio=0.05,
+                 tree_after=5):
+        """
+        :param edges: CSRGraph，需要带capacity
+        :param alpha: 拥堵的惩罚系数
+        :param decay: 每批车规划完后，已分配车辆数的衰减系数，近似前面的车已经驶离
+        :param threshold: 边权相对变化超过该值才更新，避免每批都改动大量的边
+        :param cache_size: 路线缓存的大小
+        :param rebuild_ratio: 最短路径树建立后变化的边占总边数的比例超过该值时不再修复
+        :param tree_after: 同一版本边权下出发节点的查询次数达到该值时才建立最短路径树
+        """
+        self.edges = edges
+        self.alpha = alpha
+        self.decay = decay
+        self.threshold = threshold
+        self.rebuild_ratio = rebuild_ratio
+        self.tree_after = tree_after
+        self.load = np.zeros(len(edges), dtype=np.float64)
+        self.weights = edges.weights.astype(np.float64)
+        self._weights_list = self.weights.tolist()
+        self.graph = edges.with_weights(self.weights)  # 当前边权的图，用于A*查询
+        indptr, indices = edges.indptr.tolist(), edges.indices.tolist()
+        self._out = [list(zip(indices[indptr[u]: indptr[u + 1]], range(indptr[u], indptr[u + 1])))
+                     for u in range(edges.n)]
+        self._in = [[] for _ in range(edges.n)]
+        for u in range(edges.n):
+            for v, e in self._out[u]:
+                self._in[v].append((u, e))
+        self._src = np.repeat(np.arange(edges.n), np.diff(edges.indptr))
+        self.trees = dict()  # origin -> (dist, pred, pred_edge)
+        self.tree_epoch = dict()  # origin -> 最短路径树对应的边权版本号
+        self._queries = dict()  # origin -> 当前版本边权下的查询次数
+        self._log = []  # list((epoch, changed, old_weights))，每次边权变化后的版本号、变化的边、原来的边权
+        self.epoch = 0  # 边权的版本号，update_weights改变边权时加1
+        self.cache = RouteCache(cache_size)
+
+    def _relax(self, q, dist, pred, pred_edge):
+        "从堆q中的节点出发做dijkstra松弛，dist中已有的值都是合法的上界"
+        weights, out = self._weights_list, self._out
+        while q:
+            cost, v1 = heappop(q)
+            if cost > dist[v1]:
+                continue
+            for v2, e in out[v1]:
+                if cost + weights[e] < dist[v2]:
+                    dist[v2] = cost + weights[e]
+                    pred[v2] = v1
+                    pred_edge[v2] = e
+                    heappush(q, (dist[v2], v2))
+
+    def _build_tree(self, origin):
+        n = self.edges.n
+        dist, pred, pred_edge = [float('inf')] * n, [-1] * n, [-1] * n
+        dist[origin] = 0.0
+        self._relax([(0.0, origin)], dist, pred, pred_edge)
+        self.trees[origin] = (dist, pred, pred_edge)
+        self.tree_epoch[origin] = self.epoch
+
+    def _repair_tree(self, origin, changed, old_weights):
+        """
+        边权变化后增量修复origin的最短路径树
+        :param changed: 变化的边号数组
+        :param old_weights: 这些边在最短路径树建立时的边权
+        """
+        dist, pred, pred_edge = self.trees[origin]
+        weights = self._weights_list
+        pred_edge_arr = np.array(pred_edge)
+        up = changed[self.weights[changed] > old_weights]
+        down = changed[self.weights[changed] < old_weights]
+
+        # 变长的树边下面的整棵子树失效，用指针跳跃的方式向下传播失效标记
+        bad = np.isin(pred_edge_arr, up)
+        if bad.any():
+            anc = np.array(pred)
+            anc[anc < 0] = origin
+            while True:
+                new_bad = bad | bad[anc]
+                if (new_bad == bad).all():
+                    break
+                bad = new_bad
+                anc = anc[anc]
+        q = []
+        affected = np.flatnonzero(bad).tolist()
+        for v in affected:
+            dist[v], pred[v], pred_edge[v] = float('inf'), -1, -1
+        # 失效节点从未失效的前驱重新取上界
+        for v in affected:
+            for u, e in self._in[v]:
+                if not bad[u] and dist[u] + weights[e] < dist[v]:
+                    dist[v], pred[v], pred_edge[v] = dist[u] + weights[e], u, e
+            if pred[v] >= 0:
+                heappush(q, (dist[v], v))
+        # 变短的边可能带来更短的路径
+        for e in down.tolist():
+            u, v = int(self._src[e]), int(self.edges.indices[e])
+            if dist[u] + weights[e] < dist[v]:
+                dist[v], pred[v], pred_edge[v] = dist[u] + weights[e], u, e
+                heappush(q, (dist[v], v))
+        self._relax(q, dist, pred, pred_edge)
+        self.tree_epoch[origin] = self.epoch
+
+    def _get_tree(self, origin):
+        "返回origin在当前边权下的最短路径树，树已经过期时先修复，没有树时返回None"
+        if origin not in self.trees:
+            return None
+        tree_epoch = self.tree_epoch[origin]
+        if tree_epoch < self.epoch:
+            # 合并建树之后的所有变化，同一条边取最早记录的原边权
+            entries = [entry for entry in self._log if entry[0] > tree_epoch]
+            changed = np.concatenate([entry[1] for entry in entries])
+            old_weights = np.concatenate([entry[2] for entry in entries])
+            changed, first = np.unique(changed, return_index=True)
+            old_weights = old_weights[first]
+            keep = self.weights[changed] != old_weights
+            self._repair_tree(origin, changed[keep], old_weights[keep])
+        return self.trees[origin]
+
+    def route(self, start, end):
+        """
+        查询start到end的路线
+        :return: (经过的节点list, 经过的边号list)，不可达时返回([], [])
+        """
+        cached = self.cache.get(start, end, self.epoch)
+        if cached is not None:
+            return list(cached[0]), list(cached[1])
+        tree = self._get_tree(start)
+        if tree is None:
+            count = self._queries.get(start, 0) + 1
+            self._queries[start] = count
+            if count >= self.tree_after:
+                self._build_tree(start)
+                tree = self.trees[start]
+        if tree is None:
+            _, path = self.graph.search_engine().astar(start, end)
+            path_edges = self.graph.edge_index(path[:-1], path[1:]).tolist()
+        else:
+            dist, pred, pred_edge = tree
+            if dist[end] == float('inf'):
+                return [], []
+            path, path_edges = [end], []
+            while path[-1] != start:
+                path_edges.append(pred_edge[path[-1]])
+                path.append(pred[path[-1]])
+            path.reverse()
+            path_edges.reverse()
+        self.cache.put(start, end, self.epoch, (tuple(path), tuple(path_edges)))
+        return path, path_edges
+
+    def assign(self, path_edges):
+        "把一辆车的路线计入道路的占用"
+        np.add.at(self.load, path_edges, 1)
+
+    def update_weights(self):
+        """
+        按当前占用更新边权，最短路径树在下次查询时再修复
+        :return: 发生变化的边号数组
+        """
+        new_weights = update_adjacent_matrix(self.edges, self.load, self.alpha)
+        changed = np.flatnonzero(np.abs(new_weights - self.weights) > self.threshold * self.weights)
+        if len(changed):
+            self.epoch += 1
+            self._log.append((self.epoch, changed, self.weights[changed]))
+            self.weights[changed] = new_weights[changed]
+            self._weights_list = self.weights.tolist()
+            self.graph.set_weights(self.weights)
+            self._queries.clear()
+            self._drop_stale_trees()
+        self.load *= self.decay
+        return changed
+
+    def _drop_stale_trees(self):
+        "丢弃累计变化的边超过rebuild_ratio的最短路径树，只保留还可能用到的变化记录"
+        budget = self.rebuild_ratio * len(self.edges)
+        total, keep_from = 0, len(self._log)
+        for k in range(len(self._log) - 1, -1, -1):
+            total += len(self._log[k][1])
+            if total > budget:
+                break
+            keep_from = k
+        # 版本号不小于min_epoch的树只需要log[keep_from:]中的变化
+        min_epoch = self._log[keep_from][0] - 1 if keep_from < len(self._log) else self.epoch
+        for origin in [origin for origin, epoch in self.tree_epoch.items() if epoch < min_epoch]:
+            del self.trees[origin], self.tree_epoch[origin]
+        oldest = min(self.tree_epoch.values(), default=self.epoch)
+        self._log = [entry for entry in self._log if entry[0] > oldest]
+
+
+def plan_routes_dynamic(edges, starts, ends, batch_size=100, alpha=1.0, decay=0.5, threshold=0.1,
+                        speeds=None, roadData=None):
+    """
+    分批规划路线，每批规划完后按已分配的车辆更新边权，后面的车会避开拥堵的道路
+    :param edges: CSRGraph
+    :param starts: 出发节点数组，按出发顺序排列
+    :param ends: 目的节点数组
+    :param batch_size: 每批的车辆数
+    :param speeds: 给出车速和roadData时按行驶时间规划，每个速度等级一个路由，所有路由共享道路的占用
+    :return: 与starts顺序一致的路线list
+    """
+    starts, ends = np.asarray(starts).tolist(), np.asarray(ends).tolist()
+    if speeds is None:
+        classes = [None] * len(starts)
+        routers = {None: DynamicRouter(edges, alpha=alpha, decay=1.0, threshold=threshold)}
+    else:
+        classes = np.asarray(speeds).tolist()
+        routers = {speed: DynamicRouter(graph, alpha=alpha, decay=1.0, threshold=threshold)
+                   for speed, graph in speed_class_graphs(edges, roadData, classes).items()}
+    load = np.zeros(len(edges), dtype=np.float64)
+    for router in routers.values():
+        router.load = load
+
+    paths = []
+    for i in range(0, len(starts), batch_size):
+        for start, end, speed in zip(starts[i: i + batch_size], ends[i: i + batch_size], classes[i: i + batch_size]):
+            path, path_edges = routers[speed].route(start, end)
+            routers[speed].assign(path_edges)
+            paths.append(path)
+        for router in routers.values():
+            router.update_weights()
+        load *= decay
+    return paths
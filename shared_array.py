@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+
+"""
+@File    :   shared_array.py
+@Desc    :   多进程之间共享只读的numpy数组: 主进程拷贝到共享内存，子进程按描述挂载，不复制数据
+"""
+
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+def share_array(arr):
+    "把数组拷贝到共享内存中，返回共享内存对象和子进程重建数组所需的描述"
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+    return shm, (shm.name, arr.shape, arr.dtype.str)
+
+
+def attach_array(spec):
+    "子进程中按描述挂载共享内存，不复制数据"
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
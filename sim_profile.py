@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+"""
+@File    :   sim_profile.py
+@Desc    :   调度器的逐时刻统计: 各阶段耗时、等待/停止/到达车辆数、路口最长等待队列、等待循环次数;
+             每个时刻的记录可以交给回调函数，也可以保存为CSV/NPZ
+"""
+
+import numpy as np
+
+# 每个时刻一条记录，时间单位为秒
+TRACE_DTYPE = np.dtype([('tick', np.int64),
+                        ('lane_time', np.float64),  # 车道内行驶
+                        ('cross_time', np.float64),  # 路口调度
+                        ('depart_time', np.float64),  # 车辆上路
+                        ('waiting', np.int64),  # 车道内行驶后处于等待状态的车辆数
+                        ('stopped', np.int64),  # 时刻结束时在道路上、本时刻没有移动的车辆数
+                        ('on_road', np.int64),
+                        ('finished', np.int64),  # 累计到达终点的车辆数
+                        ('departed', np.int64),
+                        ('max_queue', np.int64),  # 等待车辆最多的路口的等待车辆数
+                        ('max_queue_cross', np.int64),
+                        ('sweeps', np.int64),  # 路口调度的轮数
+                        ('iterations', np.int64)])  # 路口调度中处理道路第一辆车的次数
+
+
+class TickProfiler:
+    """
+    调度统计，传给simulate/one_second/drive_car_into_road的profiler参数;
+    不传时调度过程只多一次 is None 判断
+    每个时刻的调用顺序: begin --> lanes_done --> cross_done --> departures_done，
+    死锁等中途结束的时刻由flush补齐
+    """
+
+    def __init__(self, callback=None, keep=True):
+        """
+        :param callback: 每个时刻结束时调用 callback(record)，record为字段名-->值的dict
+        :param keep: 是否保留所有记录，只用回调时可以关闭
+        """
+        self.callback = callback
+        self.keep = keep
+        self.records = []
+        self.cross_queue = dict()  # 路口id --> 整个调度过程中的最长等待队列
+        self._record = None
+        self._road_map = None
+        self._car_lane = None
+        self._car_s1 = None
+
+    def begin(self, tick, road_map):
+        "时刻开始，记录车辆位置用于统计本时刻没有移动的车辆"
+        self.flush()
+        self._record = dict.fromkeys(TRACE_DTYPE.names, 0)
+        self._record['tick'] = tick
+        self._record['max_queue_cross'] = -1
+        self._road_map = road_map
+        self._car_lane = road_map.car_lane.copy()
+        self._car_s1 = road_map.car_s1.copy()
+
+    def lanes_done(self, elapsed, wait_count):
+        """
+        车道内行驶结束
+        :param wait_count: wait_count[cross][road]为道路上驶向路口的等待车辆数
+        """
+        record = self._record
+        record['lane_time'] = elapsed
+        max_queue, max_cross = 0, -1
+        for cross, cross_wait in wait_count.items():
+            queue = sum(cross_wait.values())
+            record['waiting'] += queue
+            if queue > max_queue:
+                max_queue, max_cross = queue, cross
+            if queue > self.cross_queue.get(cross, 0):
+                self.cross_queue[cross] = queue
+        record['max_queue'] = max_queue
+        record['max_queue_cross'] = max_cross
+
+    def cross_done(self, elapsed, sweeps, iterations):
+        "路口调度结束"
+        record = self._record
+        record['cross_time'] = elapsed
+        record['sweeps'] = sweeps
+        record['iterations'] = iterations
+
+    def departures_done(self, elapsed, depart_num):
+        "车辆上路结束，本时刻的记录完成"
+        self._record['depart_time'] = elapsed
+        self._record['departed'] = depart_num
+        self.flush()
+
+    def flush(self):
+        "统计道路上的车辆并输出当前时刻的记录"
+        record = self._record
+        if record is None:
+            return
+        self._record = None
+        road_map = self._road_map
+        on_road = road_map.car_lane >= 0
+        record['on_road'] = int(on_road.sum())
+        record['stopped'] = int((on_road & (road_map.car_lane == self._car_lane) &
+                                 (road_map.car_s1 == self._car_s1)).sum())
+        record['finished'] = int((road_map.car_state == 2).sum())
+        self._car_lane = self._car_s1 = None
+        if self.keep:
+            self.records.append(tuple(record[name] for name in TRACE_DTYPE.names))
+        if self.callback is not None:
+            self.callback(record)
+
+    def to_array(self):
+        "所有记录转为TRACE_DTYPE的结构化数组"
+        self.flush()
+        return np.array(self.records, dtype=TRACE_DTYPE)
+
+    def save(self, path):
+        """
+        保存记录，扩展名为.npz时保存为numpy压缩文件(另含每个路口的最长等待队列)，否则保存为CSV
+        """
+        trace = self.to_array()
+        if path.endswith('.npz'):
+            crosses = sorted(self.cross_queue)
+            np.savez_compressed(path, cross=np.array(crosses, dtype=np.int64),
+                                cross_queue=np.array([self.cross_queue[c] for c in crosses], dtype=np.int64),
+                                **{name: trace[name] for name in TRACE_DTYPE.names})
+        else:
+            fmt = ['%.6f' if TRACE_DTYPE[name].kind == 'f' else '%d' for name in TRACE_DTYPE.names]
+            np.savetxt(path, trace, fmt=fmt, delimiter=',', header=','.join(TRACE_DTYPE.names), comments='')
+
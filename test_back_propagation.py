@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+"""
+@File    :   test_back_propagation.py
+@Desc    :   调度器的回归测试: 向量化的车道内行驶与逐车的参考实现对比;
+             等待图提前判定的死锁与一轮调度没有进展时的判定对比
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+import back_propagation as bp
+from data_io import read_data, CarTable, RoadTable, CrossTable
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture(scope='module')
+def sample():
+    return read_data(*(os.path.join(HERE, name) for name in ('car.txt', 'road.txt', 'cross.txt')))
+
+
+def busy_plan(step=20):
+    "示例answer的出发时间压缩为1/step，道路上很快有大量等待的车辆"
+    answer_road_path = bp.load_answer_road_path(os.path.join(HERE, 'answer.txt'))
+    for temp in answer_road_path:
+        temp[1] = max(1, temp[1] // step)
+    return answer_road_path
+
+
+def drive_lanes_scalar(road_map, route_steps):
+    "drive_lanes_to_end的逐车参考实现，与向量化之前的第一遍调度一致"
+    wait_count = dict()
+    has_car = False
+    for lane in np.flatnonzero(road_map.lane_count).tolist():
+        has_car = True
+        while True:
+            car = road_map.head(lane)
+            if car < 0 or not route_steps.is_last[road_map.car_step[car]] \
+                    or road_map.car_s1[car] >= road_map.car_v[car]:
+                break
+            road_map.popleft(lane)
+            road_map.finish(car)
+        prev = -1
+        for car in road_map.lane_cars(lane):
+            s1, v = road_map.car_s1[car], road_map.car_v[car]
+            if prev < 0:
+                wait = s1 < v
+            else:
+                wait = road_map.car_state[prev] == 1 and s1 - road_map.car_s1[prev] <= v
+            if wait:
+                road_map.car_state[car] = 1
+                cross_wait = wait_count.setdefault(int(road_map.lane_cross[lane]), dict())
+                road = int(road_map.lane_road[lane])
+                cross_wait[road] = cross_wait.get(road, 0) + 1
+            else:
+                road_map.car_state[car] = 0
+                road_map.car_s1[car] = s1 - v if prev < 0 else max(s1 - v, road_map.car_s1[prev] + 1)
+            prev = car
+    return has_car, wait_count
+
+
+def test_drive_lanes_matches_scalar(sample):
+    carData, roadData, crossData = sample
+    answer_road_path = busy_plan()
+    road_map, road_info, _, cross_map, car_map = bp.generate_road_map(roadData, crossData, carData,
+                                                                      answer_road_path)
+    route_steps = bp.compile_routes(answer_road_path, roadData, crossData, carData)
+    cross_topology = bp.build_cross_topology(cross_map)
+    departures = bp.DepartureQueue(answer_road_path, route_steps)
+    max_wait = 0
+    for time_step in range(1, 50):
+        fast, slow = road_map.fork(), road_map.fork()
+        fast_result = bp.drive_lanes_to_end(fast, route_steps)
+        slow_result = drive_lanes_scalar(slow, route_steps)
+        assert fast_result == slow_result
+        # 环形队列的头指针只在有车的车道上有意义，比较车道上的车辆
+        for name in ('car_s1', 'car_state', 'car_lane', 'lane_count'):
+            assert np.array_equal(getattr(fast, name), getattr(slow, name)), name
+        assert all(fast.lane_cars(lane) == slow.lane_cars(lane) for lane in range(len(fast.lane_count)))
+        assert fast.active == set(np.flatnonzero(fast.lane_count).tolist())
+        max_wait = max(max_wait, sum(n for cross_wait in fast_result[1].values() for n in cross_wait.values()))
+
+        bp.one_second(road_info, road_map, route_steps, cross_topology)
+        bp.drive_car_into_road(time_step, car_map, route_steps, road_info, road_map, departures)
+    assert max_wait > 0
+
+
+def test_wait_for_graph_cycle():
+    wait_for = bp.WaitForGraph()
+    assert wait_for.add((1, 10), (1, 11), 0, -1) is None
+    assert wait_for.add((1, 11), (2, 20), 1, 20) is None
+    assert wait_for.add((2, 20), (1, 10), 2, 10) == [(2, 20), (1, 10), (1, 11)]
+    # (1, 11)被道路20上的车挡住，路口1还有不在环上的等待道路12时不一定是死锁
+    cycle = [(1, 10), (1, 11), (2, 20)]
+    assert bp.is_closed_cycle(cycle, wait_for, {1: {10: 1, 11: 1}, 2: {20: 1}})
+    assert not bp.is_closed_cycle(cycle, wait_for, {1: {10: 1, 11: 1, 12: 1}, 2: {20: 1}})
+    # 释放节点后等待它的边一起删除
+    wait_for.release((1, 10))
+    assert (2, 20) not in wait_for.edge and (1, 10) not in wait_for.edge
+    assert wait_for.find_cycle() is None
+
+
+def simulate_both(monkeypatch, answer_road_path, carData, roadData, crossData, max_ticks=0):
+    """
+    分别在有、没有等待图提前判定时调度同一个方案
+    :return: (提前判定的结果, 只靠一轮调度没有进展判定的结果, is_closed_cycle的返回值list)
+    """
+    closed = []
+    is_closed_cycle = bp.is_closed_cycle
+
+    def record(*args):
+        closed.append(is_closed_cycle(*args))
+        return closed[-1]
+
+    monkeypatch.setattr(bp, 'is_closed_cycle', record)
+    early = bp.simulate([list(temp) for temp in answer_road_path], carData, roadData, crossData, max_ticks)
+    monkeypatch.setattr(bp, 'is_closed_cycle', lambda *args: False)
+    fallback = bp.simulate([list(temp) for temp in answer_road_path], carData, roadData, crossData, max_ticks)
+    return early, fallback, closed
+
+
+def ring(cars_per_road):
+    """
+    4个路口的单向环路，每条路长2、1个车道，每个路口只有一条驶入的道路;
+    每条路上出发cars_per_road辆车绕环行驶3圈，每条路2辆车时环路被占满
+    """
+    roadData = RoadTable.from_array(np.array([[5000, 2, 1, 1, 1, 2, 0], [5001, 2, 1, 1, 2, 3, 0],
+                                              [5002, 2, 1, 1, 3, 4, 0], [5003, 2, 1, 1, 4, 1, 0]]))
+    crossData = CrossTable.from_array(np.array([[1, -1, 5000, 5003, -1], [2, -1, -1, 5001, 5000],
+                                                [3, 5001, -1, -1, 5002], [4, 5003, 5002, -1, -1]]))
+    roads = [5000, 5001, 5002, 5003]
+    cars, answer_road_path = [], []
+    for k in range(4):
+        for j in range(cars_per_road):
+            car_id = 10000 + k * 10 + j
+            cars.append([car_id, k + 1, k + 1, 1, 1])
+            answer_road_path.append([car_id, 1] + [roads[(k + i) % 4] for i in range(12)])
+    return answer_road_path, CarTable.from_array(np.array(cars)), roadData, crossData
+
+
+@pytest.mark.parametrize('cars_per_road, deadlock', [(1, False), (2, True)])
+def test_early_deadlock_on_ring(monkeypatch, cars_per_road, deadlock):
+    "环路被占满时提前判定发现死锁，结果与没有进展时的判定一致"
+    early, fallback, closed = simulate_both(monkeypatch, *ring(cars_per_road), max_ticks=100)
+    assert early == fallback
+    assert early[2] == deadlock
+    assert any(closed) == deadlock
+
+
+def test_early_deadlock_matches_fallback(sample, monkeypatch):
+    "大量车辆时提前判定不会误报，压缩出发时间的示例方案两种判定的结果完全一致"
+    early, fallback, _ = simulate_both(monkeypatch, busy_plan(), *sample)
+    assert early == fallback
+    assert early[2]
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+"""
+@File    :   test_road_graph.py
+@Desc    :   DynamicRouter 增量修复的最短路径树和A*路线，在随机的边权变化下与单源dijkstra对比;
+             CSRGraph.edge_index 的标量和批量查询
+"""
+
+import random
+
+import pytest
+
+from benchmark import generate_map
+from data_io import RoadTable, CrossTable
+from road_graph import create_road_between_cross_graph, shortest_path_tree, DynamicRouter
+
+
+@pytest.fixture(scope='module')
+def edges():
+    road, cross = generate_map(8, 8, seed=1, duplex_ratio=0.5)
+    _, _, edges = create_road_between_cross_graph(RoadTable.from_array(road), CrossTable.from_array(cross),
+                                                  dense=False)
+    return edges
+
+
+# (rebuild_ratio, tree_after): 总是修复、修复和丢弃交替、只用A*
+@pytest.mark.parametrize('rebuild_ratio, tree_after', [(1.0, 1), (0.05, 1), (0.3, 3), (1.0, 10 ** 6)])
+def test_dynamic_router_matches_dijkstra(edges, rebuild_ratio, tree_after):
+    rng = random.Random(0)
+    router = DynamicRouter(edges, decay=0.7, rebuild_ratio=rebuild_ratio, tree_after=tree_after)
+    repaired = 0
+    for _ in range(30):
+        reference = dict()
+        for _ in range(40):
+            # 一半的查询集中在少数出发节点上，这些节点会建立最短路径树并在之后修复
+            start = rng.choice((0, 9, 40)) if rng.random() < 0.5 else rng.randrange(edges.n)
+            end = rng.randrange(edges.n)
+            if start in router.trees and router.tree_epoch[start] < router.epoch:
+                repaired += 1
+            path, path_edges = router.route(start, end)
+            if start not in reference:
+                reference[start] = shortest_path_tree(edges.with_weights(router.weights).adjacency(), start)[0]
+            dist = reference[start]
+            if end not in dist:
+                assert path == [] and path_edges == []
+                continue
+            assert path[0] == start and path[-1] == end
+            assert (edges.indices[path_edges] == path[1:]).all()
+            assert router.weights[path_edges].sum() == pytest.approx(dist[end])
+            router.assign(path_edges)
+        router.update_weights()
+    if tree_after == 1:
+        assert repaired > 0
+
+
+def test_edge_index_scalar_and_batch(edges):
+    # 节点0的第一条出边
+    u, v = 0, int(edges.indices[edges.indptr[0]])
+    assert edges.edge_index(u, v) == edges.indptr[0]
+    assert edges.edge_index(u, u) == -1
+    assert edges.edge_index([u, u], [v, u]).tolist() == [edges.indptr[0], -1]
+    assert edges.edge_index([], []).shape == (0,)